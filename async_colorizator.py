@@ -0,0 +1,127 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+from inference import encode_image
+from utils.utils import decode_image, restore_luminance
+
+class AsyncMangaColorizator:
+    '''
+    Asyncio front-end for a MangaColorizator. Decoding, denoising, the model
+    forward and encoding run in dedicated thread pools so that the event loop
+    is never blocked, and at most max_pages pages are in flight at once. A page
+    cancelled while it waits for a free slot or a worker is never processed,
+    one cancelled during a step holds its slot until the step finishes.
+
+    Usage:
+        async with AsyncMangaColorizator(colorizator) as colorizer:
+            data = await colorizer.colorize_page(encoded_page)
+    '''
+
+    def __init__(self, colorizator, max_pages = 4, decode_workers = 2, denoise_workers = 1, model_workers = 1, encode_workers = 2):
+        self.colorizator = colorizator
+        self.max_pages = max_pages
+
+        self.decoder = ThreadPoolExecutor(decode_workers, thread_name_prefix = 'decode')
+        self.denoiser = ThreadPoolExecutor(denoise_workers, thread_name_prefix = 'denoise')
+        self.model = ThreadPoolExecutor(model_workers, thread_name_prefix = 'model')
+        self.encoder = ThreadPoolExecutor(encode_workers, thread_name_prefix = 'encode')
+
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # created lazily so that it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pages)
+
+        return self._semaphore
+
+    async def _run(self, executor, fn, *args, **kwargs):
+        job = executor.submit(fn, *args, **kwargs)
+        future = asyncio.wrap_future(job)
+
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # a started job can not be stopped, the page keeps its slot until the job finishes
+            if not job.cancel():
+                while not future.done():
+                    try:
+                        await asyncio.wait([future])
+                    except asyncio.CancelledError:
+                        pass
+
+            raise
+
+    async def decode(self, data, size = 576, apply_denoise = True, full_resolution = False):
+        '''
+        Decodes a page to grayscale at the lowest resolution the following steps allow, see inference.decode_page.
+        '''
+
+        if full_resolution or (apply_denoise and self.colorizator.denoiser.tile_size is not None):
+            return await self._run(self.decoder, decode_image, data)
+
+        return await self._run(self.decoder, decode_image, data, size, self.colorizator.denoiser.max_size if apply_denoise else None)
+
+    async def denoise(self, image, denoise_sigma = 25):
+        return await self._run(self.denoiser, self.colorizator.denoiser.get_denoised_image, image, sigma = denoise_sigma)
+
+    async def colorize(self, image, hint = None, mask = None, size = 576, apply_denoise = True, denoise_sigma = 25,
+                       full_resolution = False, as_uint8 = False):
+        '''
+        Awaitable version of MangaColorizator.colorize_image.
+        '''
+
+        source = image
+
+        if apply_denoise:
+            image = await self.denoise(image, denoise_sigma)
+
+        result = await self._run(self.model, self.colorizator.colorize_image, image, hint, mask, size, apply_denoise = False,
+                                 as_uint8 = as_uint8 and not full_resolution)
+
+        if full_resolution:
+            # colors are upsampled outside of the model thread
+            result = await self._run(self.encoder, restore_luminance, result, source)
+
+            if as_uint8:
+                result = np.round(result * 255).astype(np.uint8)
+
+        return result
+
+    async def encode(self, image, format = 'png', quality = 95, png_compression = 1):
+        options = SimpleNamespace(format = format, quality = quality, png_compression = png_compression)
+
+        return await self._run(self.encoder, encode_image, image, options)
+
+    async def colorize_page(self, data, hint = None, mask = None, size = 576, apply_denoise = True, denoise_sigma = 25,
+                            full_resolution = False, format = 'png', quality = 95, png_compression = 1):
+        '''
+        Decodes, colorizes and encodes a page.
+
+        Args:
+           data: encoded page
+           hint, mask: see MangaColorizator.colorize_image
+           format, quality, png_compression: output encoding, see inference.encode_image
+        Returns:
+           encoded colorization
+        '''
+
+        async with self.semaphore:
+            image = await self.decode(data, size, apply_denoise, full_resolution)
+            colorization = await self.colorize(image, hint, mask, size, apply_denoise, denoise_sigma, full_resolution, as_uint8 = True)
+
+            return await self.encode(colorization, format, quality, png_compression)
+
+    def close(self):
+        for executor in (self.decoder, self.denoiser, self.model, self.encoder):
+            executor.shutdown(wait = True, cancel_futures = True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
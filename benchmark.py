@@ -0,0 +1,843 @@
+import os
+import io
+import argparse
+import time
+import multiprocessing
+import threading
+import urllib.request
+import json
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import matplotlib.pyplot as plt
+import torch
+
+from colorizator import MangaColorizator, to_tensor
+from inference import process_image, encode_image, decode_page, read_file, get_image_names, IMAGE_EXTENSIONS
+import server
+from async_colorizator import AsyncMangaColorizator
+from utils.utils import get_memory_usage, resize_pad, load_image, color_difference
+from denoising.denoiser import FFDNetDenoiser
+from denoising.utils import variable_to_cv2_image
+from denoising import functions
+
+def load_pages(path, limit = None):
+    if os.path.isfile(path):
+        return [plt.imread(path)]
+
+    pages = []
+    for image_name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, image_name)
+
+        if os.path.isdir(file_path):
+            continue
+
+        pages.append(plt.imread(file_path))
+
+        if limit is not None and len(pages) >= limit:
+            break
+
+    return pages
+
+def load_colorizator(args, **kwargs):
+    kwargs.setdefault('denoiser_channels', args.denoiser_channels)
+
+    return MangaColorizator(args.device, args.generator, args.extractor, **kwargs)
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+def best_time(fn, repeat):
+    return min(timed(fn)[1] for _ in range(repeat))
+
+def peak_memory(fn, *args, **kwargs):
+    '''
+    Runs fn and returns its result, the elapsed time and the peak memory in
+    bytes allocated while it ran. On CPU the process peak RSS is used, so call
+    it in a fresh process (see isolated) to get a meaningful number.
+    '''
+
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+
+        result, elapsed = timed(fn, *args, **kwargs)
+        torch.cuda.synchronize()
+
+        return result, elapsed, torch.cuda.max_memory_allocated() - baseline
+
+    import resource
+
+    baseline = get_memory_usage()[0]
+    result, elapsed = timed(fn, *args, **kwargs)
+
+    return result, elapsed, max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline, 0)
+
+def isolated(fn, *args):
+    '''
+    Calls fn(*args) in a fresh process and returns its result.
+    '''
+
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+def benchmark_batch(args):
+    '''
+    Per-page loop of inference.colorize_images against MangaColorizator.colorize_batch.
+    '''
+
+    colorizator = load_colorizator(args)
+    pages = load_pages(args.path, args.num_pages)
+
+    def page_loop():
+        return [process_image(page, colorizator, args) for page in pages]
+
+    def batched(batch_size):
+        return colorizator.colorize_batch(pages, batch_size = batch_size, size = args.size,
+                                          apply_denoise = args.denoiser, denoise_sigma = args.denoiser_sigma, as_uint8 = True)
+
+    page_loop()
+
+    reference, elapsed = timed(page_loop)
+    print('{:>12} {:>10.3f} pages/sec'.format('per-page', len(pages) / elapsed))
+
+    for batch_size in args.batch_sizes:
+        results, elapsed = timed(batched, batch_size)
+        max_diff = max(np.abs(a.astype(np.int16) - b).max() for a, b in zip(reference, results))
+        print('{:>12} {:>10.3f} pages/sec   max abs diff {}'.format('batch ' + str(batch_size), len(pages) / elapsed, max_diff))
+
+def _guide_run(args, size, inference_only):
+    torch.set_num_threads(args.threads)
+
+    colorizator = load_colorizator(args, inference_only = inference_only)
+    page = np.random.rand(int(size * 1.4), size).astype('float32')
+
+    colorizator.set_image(page, size, apply_denoise = False)
+
+    _, _, peak = peak_memory(colorizator.colorize)
+    elapsed = best_time(colorizator.colorize, args.repeat)
+
+    return elapsed, peak
+
+def benchmark_guide(args):
+    '''
+    Generator with and without the guide decoder branch, time and peak memory per page.
+    '''
+
+    for size in args.sizes:
+        for inference_only in (False, True):
+            elapsed, peak = isolated(_guide_run, args, size, inference_only)
+            print('size {:>5} {:>14} {:>8.3f} s/page   peak {:>7.0f} MB'.format(
+                size, 'inference only' if inference_only else 'with guide', elapsed, peak / 2 ** 20))
+
+def _legacy_denoise(denoiser, image, sigma):
+    # FFDNetDenoiser.get_denoised_image before the model call was moved under no_grad
+    imorig = torch.Tensor(np.expand_dims(image.transpose(2, 0, 1), 0)).to(denoiser.device)
+    imnoisy = imorig.clone()
+    nsigma = torch.FloatTensor([sigma / 255]).to(denoiser.device)
+
+    outim = torch.clamp(imnoisy - denoiser.model(imnoisy, nsigma), 0., 1.)
+
+    return variable_to_cv2_image(outim)
+
+def _denoise_run(args, page_size, legacy):
+    torch.set_num_threads(args.threads)
+
+    denoiser = FFDNetDenoiser(args.device)
+    page = np.random.rand(page_size, page_size * 2 // 3 // 2 * 2, 3).astype('float32')
+
+    if legacy:
+        denoise = lambda: _legacy_denoise(denoiser, page, args.denoiser_sigma)
+    else:
+        denoise = lambda: denoiser.get_denoised_image(page, args.denoiser_sigma)
+
+    _, _, peak = peak_memory(denoise)
+    elapsed = best_time(denoise, args.repeat)
+
+    return elapsed, peak
+
+def benchmark_denoise(args):
+    '''
+    FFDNet denoising with autograd enabled (previous path) against the no-grad path.
+    '''
+
+    for page_size in args.page_sizes:
+        for legacy in (True, False):
+            elapsed, peak = isolated(_denoise_run, args, page_size, legacy)
+            print('page {:>5} {:>8} {:>8.3f} s/page   peak {:>7.0f} MB'.format(
+                page_size, 'autograd' if legacy else 'no grad', elapsed, peak / 2 ** 20))
+
+def _reference_concatenate_input_noise_map(input, noise_sigma):
+    # denoising.functions.concatenate_input_noise_map before pixel_unshuffle
+    N, C, H, W = input.size()
+    idxL = [[0, 0], [0, 1], [1, 0], [1, 1]]
+
+    downsampledfeatures = torch.zeros(N, 4 * C, H // 2, W // 2, dtype = input.dtype, device = input.device)
+    noise_map = noise_sigma.view(N, 1, 1, 1).repeat(1, C, H // 2, W // 2)
+
+    for idx in range(4):
+        downsampledfeatures[:, idx:4 * C:4, :, :] = input[:, :, idxL[idx][0]::2, idxL[idx][1]::2]
+
+    return torch.cat((noise_map, downsampledfeatures), 1)
+
+def _reference_upsamplefeatures(input):
+    # denoising.functions.UpSampleFeaturesFunction.forward before pixel_shuffle
+    N, Cin, Hin, Win = input.size()
+    idxL = [[0, 0], [0, 1], [1, 0], [1, 1]]
+
+    result = torch.zeros((N, Cin // 4, Hin * 2, Win * 2), dtype = input.dtype, device = input.device)
+    for idx in range(4):
+        result[:, :, idxL[idx][0]::2, idxL[idx][1]::2] = input[:, idx:Cin:4, :, :]
+
+    return result
+
+def benchmark_layers(args):
+    '''
+    FFDNet space-to-depth / depth-to-space layers against the previous loop
+    implementations, checks that both give bit-exact results.
+    '''
+
+    with torch.no_grad():
+        for page_size in args.page_sizes:
+            height, width = page_size, page_size * 2 // 3 // 2 * 2
+
+            image = torch.rand(1, 3, height, width, device = args.device)
+            sigma = torch.FloatTensor([args.denoiser_sigma / 255]).to(args.device)
+            features = torch.rand(1, 12, height // 2, width // 2, device = args.device)
+
+            cases = [
+                ('noise map', functions.concatenate_input_noise_map, _reference_concatenate_input_noise_map, (image, sigma)),
+                ('upsample', functions.upsamplefeatures, _reference_upsamplefeatures, (features,)),
+            ]
+
+            for name, fn, reference, inputs in cases:
+                if not torch.equal(fn(*inputs), reference(*inputs)):
+                    raise RuntimeError('{} differs from the reference implementation'.format(name))
+
+                elapsed = best_time(lambda: fn(*inputs), args.repeat)
+                reference_elapsed = best_time(lambda: reference(*inputs), args.repeat)
+
+                print('page {:>5} {:>10} {:>8.2f} ms   loop {:>8.2f} ms   bit-exact'.format(
+                    page_size, name, elapsed * 1000, reference_elapsed * 1000))
+
+def _psnr(a, b):
+    mse = np.mean((a.astype('float64') - b.astype('float64')) ** 2)
+
+    return 10 * np.log10(1 / mse) if mse > 0 else float('inf')
+
+def benchmark_gray(args):
+    '''
+    Grayscale FFDNet against the RGB FFDNet on the same pages: time and PSNR
+    of the denoised network input produced by resize_pad.
+    '''
+
+    pages = load_pages(args.path, args.num_pages)
+    denoisers = [('rgb', FFDNetDenoiser(args.device, _in_ch = 3)), ('gray', FFDNetDenoiser(args.device, _in_ch = 1))]
+
+    inputs = {}
+    for name, denoiser in denoisers:
+        denoise = lambda: [denoiser.get_denoised_image(page, args.denoiser_sigma) for page in pages]
+
+        denoised = denoise()
+        elapsed = best_time(denoise, args.repeat)
+
+        inputs[name] = [resize_pad(image, args.size)[0] for image in denoised]
+        print('{:>5} {:>8.3f} s/page'.format(name, elapsed / len(pages)))
+
+    psnr = [_psnr(to_tensor(rgb).numpy(), to_tensor(gray).numpy()) for rgb, gray in zip(inputs['rgb'], inputs['gray'])]
+    print('gray vs rgb network input PSNR: mean {:.2f} dB, min {:.2f} dB'.format(np.mean(psnr), np.min(psnr)))
+
+def _tiles_run(args, page_size, tile_size):
+    torch.set_num_threads(args.threads)
+
+    denoiser = FFDNetDenoiser(args.device, _in_ch = args.denoiser_channels, _tile_size = tile_size,
+                              _tile_overlap = args.tile_overlap, _tile_workers = args.tile_workers)
+    page = np.random.rand(page_size, page_size * 2 // 3).astype('float32')
+
+    denoise = lambda: denoiser.get_denoised_image(page, args.denoiser_sigma)
+
+    _, _, peak = peak_memory(denoise)
+    elapsed = best_time(denoise, args.repeat)
+
+    return elapsed, peak
+
+def benchmark_tiles(args):
+    '''
+    Denoising of large pages downscaled to 1200px against tiled denoising at full resolution.
+    '''
+
+    for page_size in args.page_sizes:
+        for tile_size in [None] + args.tile_sizes:
+            elapsed, peak = isolated(_tiles_run, args, page_size, tile_size)
+            print('page {:>5} {:>12} {:>8.3f} s/page   peak {:>7.0f} MB'.format(
+                page_size, 'tile ' + str(tile_size) if tile_size else 'downscaled', elapsed, peak / 2 ** 20))
+
+def benchmark_fullres(args):
+    '''
+    Colorization at --size upsampled with restore_luminance against running the
+    generator directly at each of --sizes.
+    '''
+
+    colorizator = load_colorizator(args)
+
+    for size in args.sizes:
+        page = np.random.rand(size * 3 // 2, size).astype('float32')
+
+        def low_resolution():
+            colorizator.set_image(page, args.size, apply_denoise = False)
+            return colorizator.colorize(full_resolution = True)
+
+        def high_resolution():
+            colorizator.set_image(page, size, apply_denoise = False)
+            return colorizator.colorize()
+
+        for name, fn in (('{} + chroma upsampling'.format(args.size), low_resolution), ('generator at {}'.format(size), high_resolution)):
+            fn()
+            print('page {:>5} {:>26} {:>8.3f} s/page'.format(size, name, best_time(fn, args.repeat)))
+
+def _decode_run(args, image_path, reduced):
+    if reduced:
+        decode = lambda: load_image(image_path, args.size, FFDNetDenoiser.max_size if args.denoiser else None)
+    else:
+        decode = lambda: plt.imread(image_path)
+
+    image, _, peak = peak_memory(decode)
+    elapsed = best_time(decode, args.repeat)
+
+    return elapsed, peak, image.shape
+
+def benchmark_decode(args):
+    '''
+    plt.imread against load_image decoding to grayscale, with decoder-side
+    downscaling of JPEG pages, time and peak memory per page.
+    '''
+
+    paths = [args.path] if os.path.isfile(args.path) else [os.path.join(args.path, name) for name in sorted(os.listdir(args.path))]
+    paths = [path for path in paths if os.path.isfile(path)][:args.num_pages]
+
+    for image_path in paths:
+        for reduced in (False, True):
+            elapsed, peak, shape = isolated(_decode_run, args, image_path, reduced)
+            print('{:>24} {:>10} {:>8.2f} ms   peak {:>7.1f} MB   {}'.format(
+                os.path.basename(image_path), 'load_image' if reduced else 'plt.imread', elapsed * 1000, peak / 2 ** 20, shape))
+
+def benchmark_encode(args):
+    '''
+    plt.imsave of float pages against encode_image with every output format,
+    run it on colorized pages (e.g. -p figures -n 12 includes color*.png).
+    '''
+
+    pages = [page[:, :, :3] for page in load_pages(args.path, args.num_pages) if len(page.shape) == 3]
+    pages = [page.astype('float32') / 255 if page.dtype == np.uint8 else page for page in pages]
+    pages_uint8 = [np.round(page * 255).astype(np.uint8) for page in pages]
+
+    def imsave():
+        sizes = []
+        for page in pages:
+            buffer = io.BytesIO()
+            plt.imsave(buffer, page, format = 'png')
+            sizes.append(buffer.tell())
+        return sizes
+
+    configs = [('png', 95, level) for level in (1, 3, 6, 9)] + [('webp', quality, 1) for quality in (80, 95)] + [('jpg', quality, 1) for quality in (90, 95)]
+
+    sizes = imsave()
+    elapsed = best_time(imsave, args.repeat)
+    print('{:>16} {:>8.2f} pages/sec   {:>7.0f} KB/page'.format('plt.imsave', len(pages) / elapsed, np.mean(sizes) / 1024))
+
+    for image_format, quality, png_compression in configs:
+        options = SimpleNamespace(format = image_format, quality = quality, png_compression = png_compression)
+        encode = lambda: [len(encode_image(page, options)) for page in pages_uint8]
+
+        sizes = encode()
+        elapsed = best_time(encode, args.repeat)
+        name = '{} {}'.format(image_format, png_compression if image_format == 'png' else quality)
+        print('{:>16} {:>8.2f} pages/sec   {:>7.0f} KB/page'.format(name, len(pages) / elapsed, np.mean(sizes) / 1024))
+
+def benchmark_server(args):
+    '''
+    Throughput and latency of server.py under --clients concurrent local
+    clients for every batch size, max wait -mw milliseconds.
+    '''
+
+    colorizator = load_colorizator(args)
+
+    if os.path.isfile(args.path):
+        files = [args.path]
+    else:
+        files = [os.path.join(args.path, name) for name in get_image_names(args.path)
+                 if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+    pages = [read_file(file_path) for file_path in files[:args.num_pages]]
+
+    def client(address, requests):
+        for i in range(requests):
+            request = urllib.request.Request(address + '/colorize', data = pages[i % len(pages)])
+            with urllib.request.urlopen(request) as response:
+                response.read()
+
+    for batch_size in args.batch_sizes:
+        options = server.parse_args(['--port', '0', '-s', str(args.size), '-bs', str(batch_size), '-mw', str(args.max_wait),
+                                     '-ds', str(args.denoiser_sigma)])
+        options.denoiser = args.denoiser
+
+        httpd = server.make_server(colorizator, options)
+        address = 'http://{}:{}'.format(*httpd.server_address)
+        threading.Thread(target = httpd.serve_forever, daemon = True).start()
+
+        client(address, 1)
+
+        clients = [threading.Thread(target = client, args = (address, len(pages))) for _ in range(args.clients)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        with urllib.request.urlopen(address + '/stats') as response:
+            stats = json.loads(response.read())
+
+        httpd.shutdown()
+        httpd.server_close()
+
+        print('{:>12} {:>8.3f} pages/sec   latency p50 {:.0f} ms p90 {:.0f} ms p99 {:.0f} ms   batches {}'.format(
+              'batch ' + str(batch_size), args.clients * len(pages) / elapsed, stats['latency_ms']['p50'],
+              stats['latency_ms']['p90'], stats['latency_ms']['p99'], stats['batch_sizes']))
+
+async def _event_loop_lag(submit, pages, clients, interval = 0.01):
+    '''
+    Runs submit(page) for every page from clients concurrent tasks while a
+    ticker measures how late the event loop wakes it up. Returns the elapsed
+    time and the ticker delays in seconds.
+    '''
+
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - start - interval)
+
+    async def client():
+        for page in pages:
+            await submit(page)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    elapsed = time.perf_counter() - start
+
+    done.set()
+    await ticker_task
+
+    return elapsed, np.array(lags)
+
+def benchmark_async(args):
+    '''
+    Event loop responsiveness and throughput with --clients concurrent page
+    submissions: blocking calls to process_image and encode_image inside
+    coroutines against AsyncMangaColorizator.
+    '''
+
+    colorizator = load_colorizator(args)
+
+    if os.path.isfile(args.path):
+        files = [args.path]
+    else:
+        files = [os.path.join(args.path, name) for name in get_image_names(args.path)
+                 if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+    pages = [read_file(file_path) for file_path in files[:args.num_pages]]
+
+    options = SimpleNamespace(format = 'png', quality = 95, png_compression = 1, size = args.size, denoiser = args.denoiser,
+                              denoiser_sigma = args.denoiser_sigma, full_resolution = False)
+
+    async def blocking(page):
+        image = decode_page(page, colorizator, options)
+        return encode_image(process_image(image, colorizator, options), options)
+
+    async def run_async():
+        async with AsyncMangaColorizator(colorizator, max_pages = args.clients) as colorizer:
+            submit = lambda page: colorizer.colorize_page(page, size = args.size, apply_denoise = args.denoiser,
+                                                          denoise_sigma = args.denoiser_sigma)
+            return await _event_loop_lag(submit, pages, args.clients)
+
+    process_image(decode_page(pages[0], colorizator, options), colorizator, options)
+
+    for name, run in (('blocking', lambda: _event_loop_lag(blocking, pages, args.clients)), ('async', run_async)):
+        elapsed, lags = asyncio.run(run())
+        lags = lags * 1000 if len(lags) else np.zeros(1)
+
+        print('{:>10} {:>8.3f} pages/sec   loop lag p50 {:.1f} ms p99 {:.1f} ms max {:.1f} ms   {} ticks'.format(
+              name, args.clients * len(pages) / elapsed, np.percentile(lags, 50), np.percentile(lags, 99), lags.max(), len(lags)))
+
+def _quantize_run(args, quantized):
+    torch.set_num_threads(args.threads)
+
+    colorizator = load_colorizator(args)
+    pages = load_pages(args.path, args.num_pages)
+    pages = [np.ascontiguousarray(page[:, :, 0]) if len(page.shape) == 3 else page for page in pages]
+
+    if quantized:
+        if args.quantized is not None:
+            colorizator.load_quantized(args.quantized)
+        else:
+            colorizator.quantize(pages, args.size, args.denoiser, args.denoiser_sigma)
+
+    colorize = lambda: [colorizator.colorize_image(page, size = args.size, apply_denoise = args.denoiser,
+                                                   denoise_sigma = args.denoiser_sigma) for page in pages]
+
+    outputs, _, peak = peak_memory(colorize)
+    elapsed = best_time(colorize, args.repeat)
+
+    return outputs, elapsed / len(pages), peak, get_memory_usage()[0]
+
+def benchmark_quantize(args):
+    '''
+    Float32 against int8 colorization: time per page, peak and resident memory
+    and the CIE76 color difference of the int8 output. Uses the model saved by
+    quantize.py with -qz, otherwise calibrates on the benchmark pages.
+    '''
+
+    reference, elapsed, peak, rss = isolated(_quantize_run, args, False)
+    print('{:>8} {:>8.3f} s/page   peak {:>7.0f} MB   rss {:>7.0f} MB'.format('float32', elapsed, peak / 2 ** 20, rss / 2 ** 20))
+
+    outputs, elapsed, peak, rss = isolated(_quantize_run, args, True)
+    delta_e = np.concatenate([color_difference(a, b).ravel() for a, b in zip(reference, outputs)])
+
+    print('{:>8} {:>8.3f} s/page   peak {:>7.0f} MB   rss {:>7.0f} MB   delta E mean {:.2f} p95 {:.2f} max {:.2f}'.format(
+          'int8', elapsed, peak / 2 ** 20, rss / 2 ** 20, delta_e.mean(), np.percentile(delta_e, 95), delta_e.max()))
+
+def benchmark_precision(args):
+    '''
+    Time per page and CIE76 color difference from float32 for every precision.
+    '''
+
+    pages = load_pages(args.path, args.num_pages)
+    references = None
+
+    for precision in MangaColorizator.precisions:
+        colorizator = load_colorizator(args, precision = precision)
+
+        colorize = lambda: [colorizator.colorize_image(page, size = args.size, apply_denoise = args.denoiser,
+                                                       denoise_sigma = args.denoiser_sigma) for page in pages]
+
+        outputs = colorize()
+        elapsed = best_time(colorize, args.repeat)
+
+        if references is None:
+            references = outputs
+
+        delta_e = np.concatenate([color_difference(a, b).ravel() for a, b in zip(references, outputs)])
+
+        print('{:>9} {:>8.3f} s/page   delta E mean {:.2f} p95 {:.2f} max {:.2f}'.format(
+              precision, elapsed / len(pages), delta_e.mean(), np.percentile(delta_e, 95), delta_e.max()))
+
+def _layer_times(groups, run, repeat):
+    '''
+    Best time over repeat runs spent in every group of modules, groups maps
+    a name to a list of modules.
+    '''
+
+    totals = {name : 0.0 for name in groups}
+    starts = {}
+    handles = []
+
+    for name, modules in groups.items():
+        for module in modules:
+            def pre_hook(module, args):
+                starts[module] = time.perf_counter()
+
+            def hook(module, args, output, name = name):
+                totals[name] += time.perf_counter() - starts[module]
+
+            handles.append(module.register_forward_pre_hook(pre_hook))
+            handles.append(module.register_forward_hook(hook))
+
+    run()
+
+    best = {name : float('inf') for name in groups}
+    for _ in range(repeat):
+        totals.update((name, 0.0) for name in groups)
+        run()
+        best.update((name, min(best[name], totals[name])) for name in groups)
+
+    for handle in handles:
+        handle.remove()
+
+    return best
+
+def benchmark_fusion(args):
+    '''
+    Encoder and denoiser time per layer group with batchnorm folded into the
+    convolutions and with channels-last layout, and the largest output difference.
+    '''
+
+    configs = [('baseline', {}), ('folded', {'fold_batchnorm' : True}), ('channels last', {'channels_last' : True}),
+               ('both', {'fold_batchnorm' : True, 'channels_last' : True})]
+
+    page = np.random.rand(args.size * 3 // 2, args.size).astype('float32')
+    noisy_page = np.random.rand(args.page_sizes[0], args.page_sizes[0] * 2 // 3 // 2 * 2).astype('float32')
+
+    rows = {}
+    references = None
+
+    for name, options in configs:
+        colorizator = load_colorizator(args, **options)
+
+        encoder = colorizator.colorizer.generator.encoder
+        body = colorizator.denoiser.model.intermediate_dncnn.itermediate_dncnn
+        position = lambda i: [body[j] for j in range(i, len(body) - 1, 3)]
+
+        groups = {'encoder ' + child : [getattr(encoder, child)] for child in ('conv1', 'bn1', 'layer1', 'layer2', 'layer3')}
+        groups.update({'denoiser conv' : position(2), 'denoiser bn' : position(3), 'denoiser body' : [body]})
+
+        image, _ = colorizator._prepare_image(page, args.size, False, args.denoiser_sigma, to_tensor)
+
+        def run():
+            with torch.no_grad():
+                features = colorizator.colorizer.encode(torch.cat([image, colorizator._empty_hint(image)], 1))
+            return [feature.float() for feature in features] + [colorizator.denoiser.get_denoised_image(noisy_page, args.denoiser_sigma)]
+
+        outputs = run()
+        if references is None:
+            references = outputs
+
+        max_diff = max(float(np.abs(np.asarray(a) - np.asarray(b)).max()) for a, b in zip(references, outputs))
+        print('{:>14} max abs diff {:.2e}'.format(name, max_diff))
+
+        for group, elapsed in _layer_times(groups, run, args.repeat).items():
+            rows.setdefault(group, []).append(elapsed)
+
+    print('{:>16}'.format('') + ''.join('{:>16}'.format(name) for name, _ in configs))
+    for group, times in rows.items():
+        print('{:>16}'.format(group) + ''.join('{:>9.1f} ms {:>3.1f}x'.format(t * 1000, times[0] / t if t > 0 else 0) for t in times))
+
+def _jit_run(args, jit_cache_dir):
+    torch.set_num_threads(args.threads)
+
+    start = time.perf_counter()
+    colorizator = load_colorizator(args, jit_cache_dir = jit_cache_dir)
+    startup = time.perf_counter() - start
+
+    pages = load_pages(args.path, args.num_pages)
+    colorize = lambda page: colorizator.colorize_image(page, size = args.size, apply_denoise = args.denoiser,
+                                                       denoise_sigma = args.denoiser_sigma)
+
+    _, first_page = timed(colorize, pages[0])
+    elapsed = best_time(lambda: [colorize(page) for page in pages], args.repeat)
+
+    return startup, first_page, len(pages) / elapsed
+
+def benchmark_jit(args):
+    '''
+    Eager models against TorchScript traces: startup time, first page latency
+    and steady-state throughput, each in a fresh process. The first compiled
+    run traces the models into an empty cache, the second loads them.
+    '''
+
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, jit_cache_dir in (('eager', None), ('traced', cache_dir), ('cached trace', cache_dir)):
+            startup, first_page, throughput = isolated(_jit_run, args, jit_cache_dir)
+            print('{:>14} startup {:>7.2f} s   first page {:>7.2f} s   {:>7.3f} pages/sec'.format(name, startup, first_page, throughput))
+
+def benchmark_startup(args):
+    '''
+    Wall time of python inference.py on a single page, from process start to
+    the saved output, with pickled weights and with .weights files written
+    by convert_weights.py (converted into a temporary folder).
+    '''
+
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+
+    from convert_weights import convert
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference.py')
+    page = args.path if os.path.isfile(args.path) else os.path.join(args.path, get_image_names(args.path)[0])
+    denoiser_dir = os.path.join('denoising', 'models')
+
+    with tempfile.TemporaryDirectory() as root:
+        configs = []
+        for name in ('pickle', 'converted'):
+            folder = os.path.join(root, name)
+            os.makedirs(os.path.join(folder, denoiser_dir))
+            shutil.copy(page, os.path.join(folder, 'page' + os.path.splitext(page)[1]))
+
+            for weights_name in os.listdir(denoiser_dir):
+                if weights_name.endswith('.pth'):
+                    os.symlink(os.path.abspath(os.path.join(denoiser_dir, weights_name)), os.path.join(folder, denoiser_dir, weights_name))
+                    if name == 'converted':
+                        convert(os.path.join(denoiser_dir, weights_name), os.path.join(folder, denoiser_dir, weights_name[:-4] + '.weights'), True)
+
+            generator = os.path.abspath(args.generator)
+            if name == 'converted':
+                generator = os.path.join(folder, 'generator.weights')
+                convert(args.generator, generator)
+
+            configs.append((name, folder, generator))
+
+        for name, folder, generator in configs:
+            command = [sys.executable, script, '-p', 'page' + os.path.splitext(page)[1], '-gen', generator, '-s', str(args.size)]
+            if not args.denoiser:
+                command.append('-nd')
+
+            # imports and weight loading only
+            load = [sys.executable, '-c', 'import sys; sys.path.insert(0, {!r}); from colorizator import MangaColorizator; '
+                    'MangaColorizator("cpu", {!r})'.format(os.path.dirname(script), generator)]
+
+            ready = best_time(lambda: subprocess.run(load, cwd = folder, check = True), args.repeat)
+            elapsed = best_time(lambda: subprocess.run(command, cwd = folder, check = True, stdout = subprocess.DEVNULL), args.repeat)
+            print('{:>10} {:>8.2f} s to model ready   {:>8.2f} s to first page'.format(name, ready, elapsed))
+
+def _host_memory_used():
+    with open('/proc/meminfo') as f:
+        info = {line.split(':')[0] : int(line.split()[1]) * 1024 for line in f}
+
+    return info['MemTotal'] - info['MemAvailable']
+
+def _sharing_worker(args, folder, page, mmap_weights, ready, done):
+    torch.set_num_threads(1)
+    os.chdir(folder)
+
+    colorizator = MangaColorizator('cpu', 'generator.weights', args.extractor, denoiser_channels = args.denoiser_channels,
+                                   mmap_weights = mmap_weights)
+
+    # a page touches every weight, so mapped pages are resident as well
+    colorizator.colorize_image(page, size = args.size, apply_denoise = args.denoiser, denoise_sigma = args.denoiser_sigma)
+
+    # return freed activations to the system so that only live memory is measured
+    try:
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+    ready.put(os.getpid())
+    done.wait()
+
+def benchmark_sharing(args):
+    '''
+    Memory of --processes independent colorizer processes with one page
+    colorized each, with weights copied into every process and with weights
+    mapped from the same .weights files (converted into a temporary folder).
+    '''
+
+    import tempfile
+
+    from convert_weights import convert
+
+    page = load_pages(args.path, 1)[0]
+    denoiser_dir = os.path.join('denoising', 'models')
+    context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(os.path.join(folder, denoiser_dir))
+        convert(args.generator, os.path.join(folder, 'generator.weights'))
+
+        for weights_name in os.listdir(denoiser_dir):
+            if weights_name.endswith('.pth'):
+                convert(os.path.join(denoiser_dir, weights_name), os.path.join(folder, denoiser_dir, weights_name[:-4] + '.weights'), True)
+
+        for processes in args.processes:
+            for name, mmap_weights in (('copied', False), ('mapped', True)):
+                ready = context.Queue()
+                done = context.Event()
+
+                host_before = _host_memory_used()
+
+                workers = [context.Process(target = _sharing_worker, args = (args, folder, page, mmap_weights, ready, done))
+                           for _ in range(processes)]
+
+                for worker in workers:
+                    worker.start()
+
+                usage = [get_memory_usage(ready.get()) for _ in workers]
+                host = _host_memory_used() - host_before
+
+                done.set()
+                for worker in workers:
+                    worker.join()
+
+                rss = np.mean([rss for rss, _ in usage]) / 2 ** 20
+                pss = [pss for _, pss in usage]
+                pss = 'n/a' if None in pss else '{:.0f} MB'.format(sum(pss) / 2 ** 20)
+
+                print('{:>3} processes {:>7}: rss {:>6.0f} MB per process, total pss {:>8}, host memory +{:.0f} MB'.format(
+                      processes, name, rss, pss, host / 2 ** 20))
+
+MODES = {
+    'batch' : benchmark_batch,
+    'guide' : benchmark_guide,
+    'denoise' : benchmark_denoise,
+    'layers' : benchmark_layers,
+    'gray' : benchmark_gray,
+    'tiles' : benchmark_tiles,
+    'fullres' : benchmark_fullres,
+    'decode' : benchmark_decode,
+    'encode' : benchmark_encode,
+    'server' : benchmark_server,
+    'async' : benchmark_async,
+    'quantize' : benchmark_quantize,
+    'precision' : benchmark_precision,
+    'fusion' : benchmark_fusion,
+    'jit' : benchmark_jit,
+    'startup' : benchmark_startup,
+    'sharing' : benchmark_sharing,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices = sorted(MODES))
+    parser.add_argument("-p", "--path", default = 'figures')
+    parser.add_argument("-gen", "--generator", default = 'networks/generator.zip')
+    parser.add_argument("-ext", "--extractor", default = 'networks/extractor.pth')
+    parser.add_argument('-g', '--gpu', dest = 'gpu', action = 'store_true')
+    parser.add_argument('-nd', '--no_denoise', dest = 'denoiser', action = 'store_false')
+    parser.add_argument("-ds", "--denoiser_sigma", type = int, default = 25)
+    parser.add_argument("-dc", "--denoiser_channels", type = int, choices = [1, 3], default = 1)
+    parser.add_argument("-s", "--size", type = int, default = 576)
+    parser.add_argument("-ss", "--sizes", type = int, nargs = '+', default = [576, 1024])
+    parser.add_argument("-ps", "--page_sizes", type = int, nargs = '+', default = [600, 1200])
+    parser.add_argument("-ts", "--tile_sizes", type = int, nargs = '+', default = [512, 1024])
+    parser.add_argument("--tile_overlap", type = int, default = 32)
+    parser.add_argument("--tile_workers", type = int, default = 1)
+    parser.add_argument("-n", "--num_pages", type = int, default = None)
+    parser.add_argument("-bs", "--batch_sizes", type = int, nargs = '+', default = [1, 2, 4, 8])
+    parser.add_argument("-qz", "--quantized", default = None)
+    parser.add_argument("-c", "--clients", type = int, default = 8)
+    parser.add_argument("-np", "--processes", type = int, nargs = '+', default = [1, 4, 16])
+    parser.add_argument("-mw", "--max_wait", type = float, default = 20)
+    parser.add_argument("-r", "--repeat", type = int, default = 3)
+    parser.add_argument("-t", "--threads", type = int, default = torch.get_num_threads())
+    parser.set_defaults(gpu = False)
+    parser.set_defaults(denoiser = True)
+    # read by inference.process_image
+    parser.set_defaults(full_resolution = False)
+    args = parser.parse_args()
+
+    args.device = 'cuda' if args.gpu else 'cpu'
+
+    return args
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    print('size {}, {} threads'.format(args.size, torch.get_num_threads()))
+
+    MODES[args.mode](args)
@@ -1,62 +1,512 @@
 import torch
-from torchvision.transforms import ToTensor
 import numpy as np
 
 from networks.models import Colorizer
 from denoising.denoiser import FFDNetDenoiser
-from utils.utils import resize_pad
+from utils.utils import resize_pad, get_padded_shape, pad_to_shape, restore_luminance, color_difference, set_submodule
+from utils.fusion import fold_batchnorm as fold_batchnorm_layers
+from utils.cache import file_digest, make_key
+from utils.weights import read_state_dict
+
+def to_tensor(image):
+    '''
+    Converts an HxWxC image to a CxHxW tensor, uint8 images are scaled to [0, 1]
+    (torchvision ToTensor without importing torchvision).
+    '''
+
+    tensor = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+    if tensor.dtype == torch.uint8:
+        return tensor.float().div_(255)
+
+    return tensor
 
 class MangaColorizator:
-    def __init__(self, device, generator_path = 'networks/generator.zip', extractor_path = 'networks/extractor.pth'):
-        self.colorizer = Colorizer().to(device)
-        self.colorizer.generator.load_state_dict(torch.load(generator_path, map_location = device))
+    precisions = ('float32', 'bfloat16', 'float16')
+
+    # generator blocks that quantize and compile convert one by one, the python code between them stays eager
+    blocks = ('encoder', 'to0', 'to1', 'to2', 'to3', 'tunnel4', 'tunnel3', 'tunnel2', 'exit')
+
+    def __init__(self, device, generator_path = 'networks/generator.zip', extractor_path = 'networks/extractor.pth', inference_only = True,
+                 denoiser_channels = 1, denoiser_tile_size = None, denoiser_tile_overlap = 32, denoiser_tile_workers = 1,
+                 segment_height = None, segment_overlap = 128, segment_batch_size = 2, quantized_path = None, precision = 'float32',
+                 fold_batchnorm = False, channels_last = False, jit_cache_dir = None, mmap_weights = False):
+        if precision not in self.precisions:
+            raise RuntimeError("precision should be one of " + ', '.join(self.precisions))
+
+        if mmap_weights:
+            if torch.device(device).type != 'cpu' or not generator_path.endswith('.weights'):
+                raise RuntimeError("mapped weights need the cpu device and a .weights file written by convert_weights.py")
+
+            # parameters are created on the meta device and replaced by tensors backed by the
+            # read-only pages of the mapped file, which every process on the host shares
+            with torch.device('meta'):
+                self.colorizer = Colorizer(precision)
+
+            self.colorizer.generator.load_state_dict(read_state_dict(generator_path), assign = True)
+        else:
+            self.colorizer = Colorizer(precision).to(device)
+            self.colorizer.generator.load_state_dict(read_state_dict(generator_path, map_location = device))
+
         self.colorizer = self.colorizer.eval()
-        
-        self.denoiser = FFDNetDenoiser(device)
-        
+
+        if fold_batchnorm:
+            fold_batchnorm_layers(self.colorizer)
+
+        if channels_last:
+            self.colorizer.to(memory_format = torch.channels_last)
+            self.colorizer.channels_last = True
+
+        if inference_only:
+            self.colorizer.generator.remove_guide_decoder()
+
+        # without tiles the denoiser shrinks pages to max_size on their longest side, which would leave a
+        # long strip narrower than size, so segmented pages are denoised in tiles at full resolution
+        if segment_height is not None and denoiser_tile_size is None:
+            denoiser_tile_size = max(segment_height, 2 * denoiser_tile_overlap)
+
+        options = {'_tile_size' : denoiser_tile_size, '_tile_overlap' : denoiser_tile_overlap, '_tile_workers' : denoiser_tile_workers,
+                   '_precision' : precision, '_fold_batchnorm' : fold_batchnorm, '_channels_last' : channels_last,
+                   '_mmap_weights' : mmap_weights}
+
+        try:
+            self.denoiser = FFDNetDenoiser(device, _in_ch = denoiser_channels, **options)
+        except FileNotFoundError:
+            if denoiser_channels != 1:
+                raise
+
+            print('Grayscale denoiser weights not found, using the RGB denoiser')
+            self.denoiser = FFDNetDenoiser(device, **options)
+
+        # pages taller than segment_height are colorized in overlapping vertical segments
+        if segment_height is not None and (segment_height % 32 != 0 or segment_overlap % 32 != 0 or segment_overlap >= segment_height):
+            raise RuntimeError("segment height and overlap should be divisible by 32 and the overlap smaller than the segment")
+
+        self.segment_height = segment_height
+        self.segment_overlap = segment_overlap
+        self.segment_batch_size = segment_batch_size
+
+        self.current_source = None
         self.current_image = None
         self.current_hint = None
         self.current_pad = None
-        
+        self.current_features = None
+
         self.device = device
-        
-    def set_image(self, image, size = 576, apply_denoise = True, denoise_sigma = 25, transform = ToTensor()):
+        self.generator_path = generator_path
+        self.precision = precision
+        self.fold_batchnorm = fold_batchnorm
+        self.channels_last = channels_last
+        self.mmap_weights = mmap_weights
+        self.quantized = None
+        self.compiled = False
+
+        if quantized_path is not None:
+            self.load_quantized(quantized_path)
+
+        if jit_cache_dir is not None:
+            self.compile(jit_cache_dir)
+
+    def share_memory(self):
+        '''
+        Moves the generator and denoiser parameters to shared memory so that
+        worker processes can use them without copying.
+        '''
+
+        self.colorizer.share_memory()
+        self.denoiser.model.share_memory()
+
+        return self
+
+    def _prepare_quantization(self, example, size, apply_denoise, backend):
+        if torch.device(self.device).type != 'cpu':
+            raise RuntimeError("quantized inference is only supported on cpu")
+
+        if self.quantized is not None or self.compiled:
+            raise RuntimeError("colorizator is already quantized or compiled")
+
+        if self.precision != 'float32':
+            raise RuntimeError("quantization needs float32 precision")
+
+        generator = self.colorizer.generator
+        denoiser_modules = self.denoiser.quantized_modules if apply_denoise else ()
+
+        modules = {'generator.' + name : generator.get_submodule(name) for name in self.blocks}
+        modules.update(('denoiser.' + name, self.denoiser.model.get_submodule(name)) for name in denoiser_modules)
+
+        from utils.quantization import capture_inputs, prepare_submodules
+
+        inputs = capture_inputs(modules, lambda: self.colorize_image(example, size = size, apply_denoise = apply_denoise))
+
+        prepare_submodules(generator, self.blocks, {name : inputs['generator.' + name] for name in self.blocks}, backend)
+        prepare_submodules(self.denoiser.model, denoiser_modules, {name : inputs['denoiser.' + name] for name in denoiser_modules}, backend)
+
+        return denoiser_modules
+
+    def _convert_quantization(self, denoiser_modules, backend):
+        from utils.quantization import convert_submodules
+
+        convert_submodules(self.colorizer.generator, self.blocks)
+        convert_submodules(self.denoiser.model, denoiser_modules)
+
+        self.quantized = {'backend' : backend, 'denoiser' : len(denoiser_modules) > 0}
+
+    def quantize(self, pages, size = 576, apply_denoise = True, denoise_sigma = 25, backend = 'x86'):
+        '''
+        Converts the generator, and the denoiser with apply_denoise, to int8 with
+        static quantization. Activation ranges are calibrated on pages, which
+        should be colorized with the same size and denoising settings. CPU only.
+
+        Args:
+           pages: list of numpy.ndarray calibration pages
+        '''
+
+        denoiser_modules = self._prepare_quantization(pages[0], size, apply_denoise, backend)
+
+        for page in pages:
+            self.colorize_image(page, size = size, apply_denoise = apply_denoise, denoise_sigma = denoise_sigma)
+
+        self._convert_quantization(denoiser_modules, backend)
+
+        return self
+
+    def save_quantized(self, path):
+        if self.quantized is None:
+            raise RuntimeError("colorizator is not quantized")
+
+        state = dict(self.quantized, generator = self.colorizer.generator.state_dict())
+        if self.quantized['denoiser']:
+            state['denoiser_model'] = self.denoiser.model.state_dict()
+
+        torch.save(state, path)
+
+    def load_quantized(self, path):
+        '''
+        Loads a model saved by save_quantized. The float model is converted again
+        without calibration and the saved int8 weights and ranges are loaded into it.
+        '''
+
+        state = torch.load(path, map_location = 'cpu')
+
+        example = np.ones((64, 64), dtype = np.float32)
+        denoiser_modules = self._prepare_quantization(example, 64, state['denoiser'], state['backend'])
+        self._convert_quantization(denoiser_modules, state['backend'])
+
+        self.colorizer.generator.load_state_dict(state['generator'])
+        if state['denoiser']:
+            self.denoiser.model.load_state_dict(state['denoiser_model'])
+
+        return self
+
+    def compile(self, cache_dir):
+        '''
+        Replaces the generator blocks and the denoiser model with frozen
+        TorchScript traces. Traces accept any input size and are stored in
+        cache_dir under a key built from the weights, the device and the model
+        options, so later runs load them instead of tracing again.
+        Returns True if the traces were loaded from the cache.
+        '''
+
+        if self.quantized is not None or self.precision != 'float32':
+            raise RuntimeError("only float32 models without quantization can be compiled")
+
+        if self.compiled:
+            raise RuntimeError("colorizator is already compiled")
+
+        from utils.quantization import capture_inputs
+        from utils.compilation import trace_modules, TracedModelCache
+
+        cache = TracedModelCache(cache_dir)
+        generator = self.colorizer.generator
+
+        options = (self.device, self.fold_batchnorm, self.channels_last, torch.__version__)
+        generator_key = make_key('generator', file_digest(self.generator_path), *options)
+        denoiser_key = make_key('denoiser', file_digest(self.denoiser.weights_path), self.denoiser.channels, *options)
+
+        generator_blocks = cache.load(generator_key, self.blocks, self.device)
+        denoiser_model = cache.load(denoiser_key, ('model',), self.device)
+        cached = generator_blocks is not None and denoiser_model is not None
+
+        if not cached:
+            modules = {name : generator.get_submodule(name) for name in self.blocks}
+            modules['denoiser'] = self.denoiser.model
+
+            example = np.ones((64, 64), dtype = np.float32)
+            traced = trace_modules(modules, capture_inputs(modules, lambda: self.colorize_image(example, size = 64)))
+
+            denoiser_model = {'model' : traced.pop('denoiser')}
+            generator_blocks = traced
+
+            cache.save(generator_key, generator_blocks)
+            cache.save(denoiser_key, denoiser_model)
+
+        for name, block in generator_blocks.items():
+            set_submodule(generator, name, block)
+
+        self.denoiser.model = denoiser_model['model']
+        self.compiled = True
+
+        return cached
+
+    def _set_precision(self, precision):
+        self.precision = precision
+        self.colorizer.precision = precision
+        self.denoiser.precision = precision
+
+    def check_precision(self, pages, threshold = 2.0, size = 576, apply_denoise = True, denoise_sigma = 25):
+        '''
+        Colorizes reference pages in float32 and in the selected precision and
+        raises RuntimeError if the mean CIE76 color difference of any page
+        exceeds threshold. Returns the mean color difference of every page.
+        '''
+
+        if not pages:
+            raise RuntimeError("no reference pages to compare {} with float32".format(self.precision))
+
+        precision = self.precision
+        colorize = lambda page: self.colorize_image(page, size = size, apply_denoise = apply_denoise, denoise_sigma = denoise_sigma)
+
+        try:
+            self._set_precision('float32')
+            references = [colorize(page) for page in pages]
+        finally:
+            self._set_precision(precision)
+
+        errors = [float(color_difference(reference, colorize(page)).mean()) for reference, page in zip(references, pages)]
+
+        if max(errors) > threshold:
+            raise RuntimeError("{} colors differ from float32 by delta E {:.3g}, more than {:.3g}".format(precision, max(errors), threshold))
+
+        return errors
+
+    def get_padded_shape(self, shape, size = 576, apply_denoise = True):
+        '''
+        Returns (resized_shape, padded_shape) of the network input for a page
+        with shape (height, width), including the downscale of the denoiser.
+        '''
+
+        if apply_denoise:
+            shape = self.denoiser.get_denoised_shape(shape)
+
+        return get_padded_shape(shape, size)
+
+    def _prepare_image(self, image, size, apply_denoise, denoise_sigma, transform, shape = None):
         if (size % 32 != 0):
             raise RuntimeError("size is not divisible by 32")
-        
+
         if apply_denoise:
             image = self.denoiser.get_denoised_image(image, sigma = denoise_sigma)
-        
-        image, self.current_pad = resize_pad(image, size)
-        self.current_image = transform(image).unsqueeze(0).to(self.device)
-        self.current_hint = torch.zeros(1, 4, self.current_image.shape[2], self.current_image.shape[3]).float().to(self.device)
-    
+
+        image, pad = resize_pad(image, size)
+
+        if shape is not None:
+            image, pad = pad_to_shape(image, pad, shape)
+
+        return transform(image).unsqueeze(0).to(self.device), pad
+
+    def _prepare_hint(self, hint, mask):
+        if issubclass(hint.dtype.type, np.integer):
+            hint = hint.astype('float32') / 255
+
+        hint = (hint - 0.5) / 0.5
+        hint = torch.from_numpy(np.asarray(hint, dtype = np.float32)).permute(2, 0, 1)
+        mask = torch.from_numpy(np.asarray(mask, dtype = np.float32)).unsqueeze(0)
+
+        return torch.cat([hint * mask, mask], 0).unsqueeze(0).to(self.device)
+
+    def _empty_hint(self, image):
+        return torch.zeros(1, 4, image.shape[2], image.shape[3], dtype = torch.float32, device = self.device)
+
+    def _postprocess(self, fake_color, pad, as_uint8 = False):
+        # padding is cropped and the result converted before the copy to the host
+        if pad[0] != 0:
+            fake_color = fake_color[:, :-pad[0]]
+        if pad[1] != 0:
+            fake_color = fake_color[:, :, :-pad[1]]
+
+        result = fake_color.detach().permute(1, 2, 0) * 0.5 + 0.5
+
+        if as_uint8:
+            result = result.mul_(255).round_().clamp_(0, 255).to(torch.uint8)
+
+        return result.cpu().numpy()
+
+    def _finish(self, result, image, full_resolution, as_uint8):
+        if full_resolution:
+            result = restore_luminance(result, image)
+
+            if as_uint8:
+                result = np.round(result * 255).astype(np.uint8)
+
+        return result
+
+    def set_image(self, image, size = 576, apply_denoise = True, denoise_sigma = 25, transform = to_tensor):
+        self.current_source = image
+        self.current_image, self.current_pad = self._prepare_image(image, size, apply_denoise, denoise_sigma, transform)
+        self.current_hint = self._empty_hint(self.current_image)
+        self.current_features = None
+
     def update_hint(self, hint, mask):
         '''
         Args:
            hint: numpy.ndarray with shape (self.current_image.shape[2], self.current_image.shape[3], 3)
            mask: numpy.ndarray with shape (self.current_image.shape[2], self.current_image.shape[3])
         '''
-        
-        if issubclass(hint.dtype.type, np.integer):
-            hint = hint.astype('float32') / 255
-            
-        hint = (hint - 0.5) / 0.5
-        hint = torch.FloatTensor(hint).permute(2, 0, 1)
-        mask = torch.FloatTensor(np.expand_dims(mask, 0))
 
-        self.current_hint = torch.cat([hint * mask, mask], 0).unsqueeze(0).to(self.device)
+        self.current_hint = self._prepare_hint(hint, mask)
+
+    def _is_segmented(self, image):
+        return self.segment_height is not None and image.shape[2] > self.segment_height
+
+    def _colorize_segments(self, image, hint):
+        '''
+        Colorizes a tall page in overlapping segments of self.segment_height rows,
+        segment_batch_size at a time, and feather-blends the overlaps. Memory
+        used by the generator is bounded by the segment height.
+        '''
+
+        height = image.shape[2]
+        step = self.segment_height - self.segment_overlap
+        starts = list(range(0, height - self.segment_height, step)) + [height - self.segment_height]
+
+        ramp = torch.arange(1, self.segment_height + 1, dtype = torch.float32, device = self.device)
+        ramp = torch.minimum(ramp, ramp.flip(0)).div_(self.segment_overlap + 1).clamp_(max = 1).view(1, 1, -1, 1)
+
+        output = torch.zeros(1, 3, height, image.shape[3], device = self.device)
+        weights = torch.zeros(1, 1, height, 1, device = self.device)
+
+        sketch = torch.cat([image, hint], 1)
+
+        for batch_start in range(0, len(starts), self.segment_batch_size):
+            batch_starts = starts[batch_start:batch_start + self.segment_batch_size]
+            segments = torch.cat([sketch[:, :, start:start + self.segment_height] for start in batch_starts], 0)
+
+            with torch.no_grad():
+                fake_color, _ = self.colorizer(segments)
+
+            for start, segment in zip(batch_starts, fake_color):
+                output[:, :, start:start + self.segment_height] += segment * ramp
+                weights[:, :, start:start + self.segment_height] += ramp
+
+        return output / weights
+
+    def _generate(self, image, hint, features = None):
+        if self._is_segmented(image):
+            return self._colorize_segments(image, hint)
 
-    def colorize(self):
         with torch.no_grad():
-            fake_color, _ = self.colorizer(torch.cat([self.current_image, self.current_hint], 1))
-            fake_color = fake_color.detach()
+            fake_color, _ = self.colorizer(torch.cat([image, hint], 1), features = features)
+
+        return fake_color.detach()
+
+    def colorize_image(self, image, hint = None, mask = None, size = 576, apply_denoise = True, denoise_sigma = 25, transform = to_tensor,
+                       full_resolution = False, as_uint8 = False):
+        '''
+        Colorizes a page without reading or changing the state kept by set_image,
+        update_hint and colorize, so one instance can be used from several threads.
+
+        Args:
+           hint, mask: None or a hint and mask shaped like the padded page (see update_hint)
+           full_resolution, as_uint8: see colorize
+        '''
+
+        tensor, pad = self._prepare_image(image, size, apply_denoise, denoise_sigma, transform)
+
+        if hint is None:
+            hint = self._empty_hint(tensor)
+        else:
+            hint = self._prepare_hint(hint, mask)
+
+        result = self._postprocess(self._generate(tensor, hint)[0], pad, as_uint8 and not full_resolution)
+
+        return self._finish(result, image, full_resolution, as_uint8)
+
+    def colorize(self, full_resolution = False, as_uint8 = False):
+        '''
+        Args:
+           full_resolution: return the page at the resolution passed to set_image,
+                            with upsampled colors and the original luminance
+           as_uint8: return a uint8 image instead of float values in [0, 1]
+        '''
+
+        # encoder features depend only on the image, they are reused while the hint changes
+        if self.current_features is None and not self._is_segmented(self.current_image):
+            with torch.no_grad():
+                self.current_features = self.colorizer.encode(self.current_image)
+
+        fake_color = self._generate(self.current_image, self.current_hint, self.current_features)
+        result = self._postprocess(fake_color[0], self.current_pad, as_uint8 and not full_resolution)
+
+        return self._finish(result, self.current_source, full_resolution, as_uint8)
+
+    def colorize_batch(self, images, hints = None, batch_size = 4, size = 576, apply_denoise = True, denoise_sigma = 25, transform = to_tensor, shapes = None,
+                       full_resolution = False, as_uint8 = False):
+        '''
+        Colorizes several pages at once. Pages are grouped by their padded shape
+        and every group is fed to the generator in batches of up to batch_size.
+
+        Args:
+           images: list of numpy.ndarray pages
+           hints: None or list with a (hint, mask) pair or None for every page,
+                  shaped like the padded page (see update_hint)
+           shapes: None or list with a padded shape (height, width) for every page,
+                   pages and their hints are padded up to it so that they can share a batch
+           full_resolution, as_uint8: see colorize
+        Returns:
+           list of colorized pages in the order of images
+        '''
+
+        if hints is None:
+            hints = [None] * len(images)
+
+        if len(hints) != len(images):
+            raise RuntimeError("number of hints does not match number of images")
+
+        if shapes is None:
+            shapes = [None] * len(images)
+
+        inputs = []
+        pads = []
+        groups = {}
+
+        for i, (image, hint, shape) in enumerate(zip(images, hints, shapes)):
+            image, pad = self._prepare_image(image, size, apply_denoise, denoise_sigma, transform, shape)
+
+            if hint is None:
+                hint = self._empty_hint(image)
+            else:
+                hint = self._prepare_hint(*hint)
+
+                # a hint for the page's own padded shape gets an empty mask in the extra padding
+                extra = (image.shape[2] - hint.shape[2], image.shape[3] - hint.shape[3])
+                if min(extra) < 0:
+                    raise RuntimeError("hint is larger than the padded page")
+
+                hint = torch.nn.functional.pad(hint, (0, extra[1], 0, extra[0]))
+
+            inputs.append(torch.cat([image, hint], 1))
+            pads.append(pad)
+            groups.setdefault(tuple(image.shape[2:]), []).append(i)
+
+        results = [None] * len(images)
+
+        for shape, indices in groups.items():
+            if self._is_segmented(inputs[indices[0]]):
+                for i in indices:
+                    fake_color = self._colorize_segments(inputs[i][:, :1], inputs[i][:, 1:])
+                    results[i] = self._postprocess(fake_color[0], pads[i], as_uint8 and not full_resolution)
+                    inputs[i] = None
+
+                continue
+
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+
+                with torch.no_grad():
+                    fake_color, _ = self.colorizer(torch.cat([inputs[i] for i in chunk], 0))
 
-        result = fake_color[0].detach().cpu().permute(1, 2, 0) * 0.5 + 0.5
+                for j, i in enumerate(chunk):
+                    results[i] = self._postprocess(fake_color[j], pads[i], as_uint8 and not full_resolution)
+                    inputs[i] = None
 
-        if self.current_pad[0] != 0:
-            result = result[:-self.current_pad[0]]
-        if self.current_pad[1] != 0:
-            result = result[:, :-self.current_pad[1]]
-            
-        return result.numpy()
+        return [self._finish(result, image, full_resolution, as_uint8) for result, image in zip(results, images)]
@@ -0,0 +1,36 @@
+import os
+import argparse
+
+import torch
+
+from utils.weights import save_weights
+from denoising.utils import remove_dataparallel_wrapper
+
+def convert(source_path, target_path, dataparallel = False):
+    state_dict = torch.load(source_path, map_location = 'cpu')
+
+    if dataparallel:
+        state_dict = remove_dataparallel_wrapper(state_dict)
+
+    save_weights(state_dict, target_path)
+
+    print('{} -> {}'.format(source_path, target_path))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Converts generator and denoiser weights to .weights files that load without pickle')
+    parser.add_argument("-gen", "--generator", default = 'networks/generator.zip')
+    parser.add_argument("-dd", "--denoiser_dir", default = 'denoising/models/')
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    convert(args.generator, os.path.splitext(args.generator)[0] + '.weights')
+
+    for weights_name in ('net_gray', 'net_rgb'):
+        source_path = os.path.join(args.denoiser_dir, weights_name + '.pth')
+
+        if os.path.exists(source_path):
+            convert(source_path, os.path.join(args.denoiser_dir, weights_name + '.weights'), dataparallel = True)
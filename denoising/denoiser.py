@@ -13,6 +13,8 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 import os
 import argparse
 import time
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 
 import numpy as np
@@ -21,48 +23,160 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 from .models import FFDNet
+from utils.fusion import fold_batchnorm
+from utils.weights import read_state_dict
 from .utils import normalize, variable_to_cv2_image, remove_dataparallel_wrapper, is_rgb
     
 class FFDNetDenoiser:
-    def __init__(self, _device, _sigma = 25, _weights_dir = 'denoising/models/', _in_ch = 3):
+    # without tiling larger images are downscaled to this size before denoising
+    max_size = 1200
+    # FFDNet submodules converted to int8 by MangaColorizator.quantize
+    quantized_modules = ('intermediate_dncnn',)
+
+    def __init__(self, _device, _sigma = 25, _weights_dir = 'denoising/models/', _in_ch = 3, _tile_size = None, _tile_overlap = 32, _tile_workers = 1,
+                 _precision = 'float32', _fold_batchnorm = False, _channels_last = False, _mmap_weights = False):
         self.sigma = _sigma / 255
         self.weights_dir = _weights_dir
         self.channels = _in_ch
         self.device = _device
+        self.precision = _precision
+        self.mmap_weights = _mmap_weights
+
+        # with a tile size the image is denoised at full resolution tile by tile
+        if _tile_size is not None and (_tile_size % 2 != 0 or _tile_overlap % 2 != 0 or _tile_overlap >= _tile_size):
+            raise ValueError('Tile size and overlap should be even and the overlap smaller than the tile')
+
+        self.tile_size = _tile_size
+        self.tile_overlap = _tile_overlap
+        self.tile_workers = _tile_workers
         
-        self.model = FFDNet(num_input_channels = _in_ch)
+        # with mapped weights the parameters are only allocated by load_weights
+        with torch.device('meta') if _mmap_weights else contextlib.nullcontext():
+            self.model = FFDNet(num_input_channels = _in_ch)
+
         self.load_weights()
         self.model.eval()
+
+        if _fold_batchnorm:
+            fold_batchnorm(self.model)
+
+        # the model input is created inside FFDNet, convolutions follow the layout of the weights
+        if _channels_last:
+            self.model.to(memory_format = torch.channels_last)
        
     
+    def get_denoised_shape(self, shape):
+        '''
+        Returns the (height, width) of the denoised image for an input with shape:
+        without tiles pages larger than max_size are downscaled first.
+        '''
+
+        height, width = shape[:2]
+
+        if self.tile_size is None and max(height, width) > self.max_size:
+            ratio = max(height, width) / self.max_size
+            return int(height / ratio), int(width / ratio)
+
+        return height, width
+
     def load_weights(self):
-        weights_name = 'net_rgb.pth' if self.channels == 3 else 'net_gray.pth'
-        weights_path = os.path.join(self.weights_dir, weights_name)
+        weights_name = 'net_rgb' if self.channels == 3 else 'net_gray'
+
+        # weights converted by convert_weights.py load without pickle and need no DataParallel cleanup
+        weights_path = os.path.join(self.weights_dir, weights_name + '.weights')
+        if self.mmap_weights or os.path.exists(weights_path):
+            state_dict = read_state_dict(weights_path)
+        else:
+            weights_path = os.path.join(self.weights_dir, weights_name + '.pth')
+            state_dict = remove_dataparallel_wrapper(torch.load(weights_path, map_location = 'cpu'))
+
+        self.weights_path = weights_path
+        self.model.load_state_dict(state_dict, assign = self.mmap_weights)
+
         if self.device == 'cuda':
-            state_dict = torch.load(weights_path, map_location=torch.device('cpu'))
             device_ids = [0]
             self.model = nn.DataParallel(self.model, device_ids=device_ids).cuda()
-        else:
-            state_dict = torch.load(weights_path, map_location='cpu')
-            # CPU mode: remove the DataParallel wrapper
-            state_dict = remove_dataparallel_wrapper(state_dict)
-        self.model.load_state_dict(state_dict)
         
+    def _denoise(self, imnoisy, nsigma):
+        imnoisy = imnoisy.to(self.device, torch.float32)
+
+        with torch.no_grad(), torch.autocast(imnoisy.device.type, dtype = getattr(torch, self.precision), enabled = self.precision != 'float32'):
+            noise = self.model(imnoisy, nsigma)
+
+        # Estimate noise and subtract it to the input image
+        return noise.float().neg_().add_(imnoisy).clamp_(0., 1.)
+
+    def _tile_starts(self, length):
+        if length <= self.tile_size:
+            return [0]
+
+        starts = list(range(0, length - self.tile_size, self.tile_size - self.tile_overlap))
+        return starts + [length - self.tile_size]
+
+    def _tile_weights(self, length):
+        # linear ramp over the overlap so that neighbouring tiles blend smoothly
+        ramp = np.minimum(np.arange(1, length + 1), np.arange(length, 0, -1))
+        return np.minimum(ramp / (self.tile_overlap + 1), 1).astype(np.float32)
+
+    def _denoise_tiled(self, imorig, nsigma):
+        r"""Denoises a 1xCxHxW image with even sides in overlapping tiles of
+        self.tile_size, so that memory used by the model is bounded by the
+        tile size. Tiles start at even offsets to keep the 2x2 patches of
+        FFDNet aligned with the full image.
+        """
+        _, C, H, W = imorig.shape
+        imorig = imorig.astype(np.float32, copy = False)
+
+        output = np.zeros((C, H, W), dtype = np.float32)
+        weights = np.zeros((H, W), dtype = np.float32)
+
+        tiles = [(y, x) for y in self._tile_starts(H) for x in self._tile_starts(W)]
+
+        def denoise_tile(tile):
+            y, x = tile
+            tile = imorig[:, :, y:y + self.tile_size, x:x + self.tile_size]
+            return self._denoise(torch.from_numpy(tile), nsigma)[0].cpu().numpy()
+
+        with ThreadPoolExecutor(self.tile_workers) as executor:
+            for (y, x), denoised in zip(tiles, executor.map(denoise_tile, tiles)):
+                height, width = denoised.shape[1:]
+                weight = np.outer(self._tile_weights(height), self._tile_weights(width))
+
+                output[:, y:y + height, x:x + width] += denoised * weight
+                weights[y:y + height, x:x + width] += weight
+
+        output /= weights
+
+        return torch.from_numpy(output).unsqueeze(0)
+
     def get_denoised_image(self, imorig, sigma = None):
-        
+        r"""Denoises an image. With a grayscale model only the first channel is
+        denoised and a float32 HxW image in [0, 1] is returned, with the RGB
+        model the result is a uint8 BGR image.
+        """
+
         if sigma is not None:
             cur_sigma = sigma / 255
         else:
             cur_sigma = self.sigma 
     
-        if len(imorig.shape) < 3 or imorig.shape[2] == 1:
-            imorig = np.repeat(np.expand_dims(imorig, 2), 3, 2)
-            
-        imorig = imorig[..., :3]
+        if len(imorig.shape) < 3:
+            imorig = np.expand_dims(imorig, 2)
+
+        if self.channels == 1:
+            imorig = imorig[..., :1]
+        else:
+            if imorig.shape[2] == 1:
+                imorig = np.repeat(imorig, 3, 2)
+
+            imorig = imorig[..., :3]
+
+        shape = self.get_denoised_shape(imorig.shape)
+        if shape != imorig.shape[:2]:
+            imorig = cv2.resize(imorig, (shape[1], shape[0]), interpolation = cv2.INTER_AREA)
 
-        if (max(imorig.shape[0], imorig.shape[1]) > 1200):
-            ratio = max(imorig.shape[0], imorig.shape[1]) / 1200
-            imorig = cv2.resize(imorig, (int(imorig.shape[1] / ratio), int(imorig.shape[0] / ratio)), interpolation = cv2.INTER_AREA)
+            if len(imorig.shape) < 3:
+                imorig = np.expand_dims(imorig, 2)
 
         imorig = imorig.transpose(2, 0, 1)
  
@@ -83,35 +197,20 @@ class FFDNetDenoiser:
             imorig = np.concatenate((imorig, imorig[:, :, :, -1][:, :, :, np.newaxis]), axis=3)
 
 
-        imorig = torch.Tensor(imorig)
+        nsigma = torch.tensor([cur_sigma], dtype = torch.float32, device = self.device)
 
-
-        # Sets data type according to CPU or GPU modes
-        if self.device == 'cuda':
-            dtype = torch.cuda.FloatTensor
+        if self.tile_size is None:
+            outim = self._denoise(torch.from_numpy(imorig), nsigma)
         else:
-            dtype = torch.FloatTensor
-
-        imnoisy = imorig.clone()
-
-
-        with torch.no_grad():
-            imorig, imnoisy = imorig.type(dtype), imnoisy.type(dtype)
-            nsigma = torch.FloatTensor([cur_sigma]).type(dtype)
-
-
-        # Estimate noise and subtract it to the input image
-        im_noise_estim = self.model(imnoisy, nsigma)
-        outim = torch.clamp(imnoisy-im_noise_estim, 0., 1.)
+            outim = self._denoise_tiled(imorig, nsigma)
 
         if expanded_h:
-            imorig = imorig[:, :, :-1, :]
             outim = outim[:, :, :-1, :]
-            imnoisy = imnoisy[:, :, :-1, :]
 
         if expanded_w:
-            imorig = imorig[:, :, :, :-1]
             outim = outim[:, :, :, :-1]
-            imnoisy = imnoisy[:, :, :, :-1]
-        
+
+        if self.channels == 1:
+            return outim[0, 0].cpu().numpy()
+
         return variable_to_cv2_image(outim)
@@ -11,7 +11,8 @@ version. You should have received a copy of this license along
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import torch
-from torch.autograd import Function, Variable
+import torch.nn.functional as F
+from torch.autograd import Function
 
 def concatenate_input_noise_map(input, noise_sigma):
     r"""Implements the first layer of FFDNet. This function returns a
@@ -25,32 +26,33 @@ def concatenate_input_noise_map(input, noise_sigma):
         input: batch containing CxHxW images
         noise_sigma: the value of the pixels of the CxH/2xW/2 noise map
     """
-    # noise_sigma is a list of length batch_size
+    # noise_sigma is a list of length batch_size or 1
+    if torch.jit.is_tracing():
+        # traced as single ops so that the trace does not fix the input size
+        downsampled = F.pixel_unshuffle(input, 2)
+        noise_map = noise_sigma.view(-1, 1, 1, 1).expand_as(downsampled[:, :input.shape[1]])
+        return torch.cat([noise_map, downsampled], 1)
+
     N, C, H, W = input.size()
-    dtype = input.type()
     sca = 2
-    sca2 = sca*sca
-    Cout = sca2*C
     Hout = H//sca
     Wout = W//sca
-    idxL = [[0, 0], [0, 1], [1, 0], [1, 1]]
 
-    # Fill the downsampled image with zeros
-    if 'cuda' in dtype:
-        downsampledfeatures = torch.cuda.FloatTensor(N, Cout, Hout, Wout).fill_(0)
-    else:
-        downsampledfeatures = torch.FloatTensor(N, Cout, Hout, Wout).fill_(0)
+    # The noise map and the downsampled image are written straight into the
+    # concatenated output
+    output = input.new_empty((N, C + sca*sca*C, Hout, Wout))
 
     # Build the CxH/2xW/2 noise map
-    noise_map = noise_sigma.view(N, 1, 1, 1).repeat(1, C, Hout, Wout)
+    output[:, :C].copy_(noise_sigma.view(-1, 1, 1, 1).expand(N, C, Hout, Wout))
 
-    # Populate output
-    for idx in range(sca2):
-        downsampledfeatures[:, idx:Cout:sca2, :, :] = \
-            input[:, :, idxL[idx][0]::sca, idxL[idx][1]::sca]
+    # Pixel (i, j) of every 2x2 patch of channel c goes to channel 4*c + 2*i + j,
+    # the layout of pixel_unshuffle
+    downsampledfeatures = output[:, C:].view(N, C, sca, sca, Hout, Wout)
+    for i in range(sca):
+        for j in range(sca):
+            downsampledfeatures[:, :, i, j].copy_(input[:, :, i::sca, j::sca])
 
-    # concatenate de-interleaved mosaic with noise map
-    return torch.cat((noise_map, downsampledfeatures), 1)
+    return output
 
 class UpSampleFeaturesFunction(Function):
     r"""Extends PyTorch's modules by implementing a torch.autograd.Function.
@@ -62,40 +64,31 @@ class UpSampleFeaturesFunction(Function):
     @staticmethod
     def forward(ctx, input):
         N, Cin, Hin, Win = input.size()
-        dtype = input.type()
         sca = 2
         sca2 = sca*sca
         Cout = Cin//sca2
-        Hout = Hin*sca
-        Wout = Win*sca
-        idxL = [[0, 0], [0, 1], [1, 0], [1, 1]]
 
         assert (Cin%sca2 == 0), 'Invalid input dimensions: number of channels should be divisible by 4'
 
-        result = torch.zeros((N, Cout, Hout, Wout)).type(dtype)
-        for idx in range(sca2):
-            result[:, :, idxL[idx][0]::sca, idxL[idx][1]::sca] = input[:, idx:Cin:sca2, :, :]
+        # Inverse of the layout built by concatenate_input_noise_map, the
+        # layout of pixel_shuffle
+        result = input.new_empty((N, Cout, Hin*sca, Win*sca))
+        upsampled = result.view(N, Cout, Hin, sca, Win, sca)
+        features = input.view(N, Cout, sca, sca, Hin, Win)
+        for i in range(sca):
+            for j in range(sca):
+                upsampled[:, :, :, i, :, j].copy_(features[:, :, i, j])
 
         return result
 
     @staticmethod
     def backward(ctx, grad_output):
-        N, Cg_out, Hg_out, Wg_out = grad_output.size()
-        dtype = grad_output.data.type()
-        sca = 2
-        sca2 = sca*sca
-        Cg_in = sca2*Cg_out
-        Hg_in = Hg_out//sca
-        Wg_in = Wg_out//sca
-        idxL = [[0, 0], [0, 1], [1, 0], [1, 1]]
-
-        # Build output
-        grad_input = torch.zeros((N, Cg_in, Hg_in, Wg_in)).type(dtype)
-        # Populate output
-        for idx in range(sca2):
-            grad_input[:, idx:Cg_in:sca2, :, :] = grad_output.data[:, :, idxL[idx][0]::sca, idxL[idx][1]::sca]
-
-        return Variable(grad_input)
+        return F.pixel_unshuffle(grad_output, 2)
 
 # Alias functions
-upsamplefeatures = UpSampleFeaturesFunction.apply
+def upsamplefeatures(input):
+    # the autograd function is traced with a fixed input size, pixel_shuffle is the same operation
+    if torch.jit.is_tracing():
+        return F.pixel_shuffle(input, 2)
+
+    return UpSampleFeaturesFunction.apply(input)
@@ -11,7 +11,6 @@ version. You should have received a copy of this license along
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import torch.nn as nn
-from torch.autograd import Variable
 import denoising.functions as functions
     
 class UpSampleFeatures(nn.Module):
@@ -93,8 +92,8 @@ class FFDNet(nn.Module):
         self.upsamplefeatures = UpSampleFeatures()
 
     def forward(self, x, noise_sigma):
-        concat_noise_x = functions.concatenate_input_noise_map(x.data, noise_sigma.data)
-        concat_noise_x = Variable(concat_noise_x)
+        # detach() rather than .data so that tracing records the inputs
+        concat_noise_x = functions.concatenate_input_noise_map(x.detach(), noise_sigma.detach())
         h_dncnn = self.intermediate_dncnn(concat_noise_x)
         pred_noise = self.upsamplefeatures(h_dncnn)
         return pred_noise
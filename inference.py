@@ -1,46 +1,455 @@
 import os
+import re
 import argparse
 import sys
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import matplotlib.pyplot as plt
+import cv2
 
 from colorizator import MangaColorizator
+from utils.utils import make_buckets, get_memory_usage, decode_image, get_decoded_shape
+from utils.cache import ResultCache, file_digest, make_key
 
 def process_image(image, colorizator, args):
-    colorizator.set_image(image, args.size, args.denoiser, args.denoiser_sigma)
-        
-    return colorizator.colorize()
+    return colorizator.colorize_image(image, size = args.size, apply_denoise = args.denoiser, denoise_sigma = args.denoiser_sigma,
+                                      full_resolution = args.full_resolution, as_uint8 = True)
     
+ARCHIVE_EXTENSIONS = ('.cbz', '.zip')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def decode_page(data, colorizator, args):
+    '''
+    Decodes a page to grayscale at the lowest resolution the following steps
+    allow: the denoiser input size, or the network input size without denoising.
+    '''
+
+    return decode_image(data, *get_decode_options(colorizator, args))
+
+def get_decode_options(colorizator, args):
+    '''
+    Returns the size and min_side arguments of decode_image for pages.
+    '''
+
+    if args.full_resolution or (args.denoiser and colorizator.denoiser.tile_size is not None):
+        return None, None
+
+    return args.size, colorizator.denoiser.max_size if args.denoiser else None
+
+def read_page(image_path, colorizator, args):
+    return decode_page(read_file(image_path), colorizator, args)
+
 def colorize_single_image(image_path, save_path, colorizator, args):
     
-        image = plt.imread(image_path)
+        image = read_page(image_path, colorizator, args)
 
         colorization = process_image(image, colorizator, args)
         
-        plt.imsave(save_path, colorization)
+        save_image(save_path, colorization, args)
         
         return True
     
 
-def colorize_images(target_path, colorizator, args):
-    images = os.listdir(args.path)
-    
-    for image_name in images:
-        file_path = os.path.join(args.path, image_name)
-        
-        if os.path.isdir(file_path):
-            continue
-        
-        name, ext = os.path.splitext(image_name)
-        if (ext != '.png'):
-            image_name = name + '.png'
-        
-        print(file_path)
-        
-        save_path = os.path.join(target_path, image_name)
-        colorize_single_image(file_path, save_path, colorizator, args)
-    
+def natural_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def get_image_names(path):
+    images = [image_name for image_name in os.listdir(path) if not os.path.isdir(os.path.join(path, image_name))]
+
+    return sorted(images, key = natural_key)
+
+def get_save_path(target_path, image_name, args):
+    name, ext = os.path.splitext(image_name)
+    if (ext != '.' + args.format):
+        image_name = name + '.' + args.format
+
+    return os.path.join(target_path, image_name)
+
+def encode_image(image, args):
+    '''
+    Encodes an RGB page in args.format, returns the encoded bytes.
+    '''
+
+    if image.dtype != np.uint8:
+        image = np.round(np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+    if args.format == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, args.png_compression]
+    elif args.format == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, args.quality]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, args.quality]
+
+    success, data = cv2.imencode('.' + args.format, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)
+
+    if not success:
+        raise RuntimeError("image can not be encoded")
+
+    return data.tobytes()
+
+def save_image(save_path, image, args):
+    data = encode_image(image, args)
+
+    with open(save_path, 'wb') as f:
+        f.write(data)
+
+def get_page_shape(image_path, colorizator, args):
+    '''
+    Returns the shape read_page decodes a page to, computed from the image header.
+    '''
+
+    from PIL import Image
+
+    with Image.open(image_path) as image:
+        shape = (image.height, image.width)
+        jpeg = image.format == 'JPEG'
+
+    size, min_side = get_decode_options(colorizator, args)
+
+    if jpeg and size is not None:
+        shape = get_decoded_shape(shape, size, min_side)
+
+    return shape
+
+def colorize_pages(pages, read, write, colorizator, args):
+    '''
+    Colorizes pages one by one. read(page) returns the encoded page and
+    write(page, data) stores the encoded colorization.
+    '''
+
+    for page in pages:
+        print(page)
+
+        image = decode_page(read(page), colorizator, args)
+        colorization = process_image(image, colorizator, args)
+
+        write(page, encode_image(colorization, args))
+
+def colorize_pages_pipeline(pages, read, write, colorizator, args):
+    '''
+    Streams pages through three stages: a pool of readers decoding pages, the
+    model in the calling thread and a pool of writers encoding results, which
+    are passed to write in page order. At most args.read_queue decoded pages
+    and args.write_queue colorized pages are held in memory.
+    '''
+
+    pages = iter(pages)
+    pending_reads = deque()
+    pending_writes = deque()
+
+    def read_and_decode(page):
+        return decode_page(read(page), colorizator, args)
+
+    with ThreadPoolExecutor(args.readers) as readers, ThreadPoolExecutor(args.writers) as writers:
+
+        def fill_read_queue():
+            while len(pending_reads) < args.read_queue:
+                page = next(pages, None)
+                if page is None:
+                    break
+
+                pending_reads.append((page, readers.submit(read_and_decode, page)))
+
+        def flush_write_queue(limit):
+            while len(pending_writes) > limit:
+                page, data = pending_writes.popleft()
+                write(page, data.result())
+
+        fill_read_queue()
+
+        while pending_reads:
+            page, image = pending_reads.popleft()
+            image = image.result()
+            fill_read_queue()
+
+            print(page)
+
+            colorization = process_image(image, colorizator, args)
+            del image
+
+            flush_write_queue(args.write_queue - 1)
+            pending_writes.append((page, writers.submit(encode_image, colorization, args)))
+
+        flush_write_queue(0)
+
+def get_folder_pages(target_path, args, images = None):
+    '''
+    Returns the page paths of the folder args.path together with a writer
+    saving colorizations to target_path.
+    '''
+
+    if images is None:
+        images = get_image_names(args.path)
+
+    def write(file_path, data):
+        with open(get_save_path(target_path, os.path.basename(file_path), args), 'wb') as f:
+            f.write(data)
+
+    return [os.path.join(args.path, image_name) for image_name in images], write
+
+def colorize_images(target_path, colorizator, args, images = None):
+    pages, write = get_folder_pages(target_path, args, images)
+
+    colorize_pages(pages, read_file, write, colorizator, args)
+
+def colorize_images_pipeline(target_path, colorizator, args, images = None):
+    pages, write = get_folder_pages(target_path, args, images)
+
+    colorize_pages_pipeline(pages, read_file, write, colorizator, args)
+
+def colorize_archive(archive_path, save_path, colorizator, args):
+    '''
+    Colorizes the pages of a .cbz/.zip archive in natural order and streams
+    them into a new archive at save_path without temporary files. Only the
+    pages in flight are held in memory. Other members, such as ComicInfo.xml,
+    are copied unchanged.
+    '''
+
+    with zipfile.ZipFile(archive_path) as source, zipfile.ZipFile(save_path, 'w', zipfile.ZIP_STORED) as target:
+        pages = []
+        for info in source.infolist():
+            if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in IMAGE_EXTENSIONS:
+                pages.append(info.filename)
+            else:
+                target.writestr(info, source.read(info))
+
+        pages.sort(key = natural_key)
+
+        def write(page, data):
+            target.writestr(os.path.splitext(page)[0] + '.' + args.format, data)
+
+        if args.pipeline:
+            colorize_pages_pipeline(pages, source.read, write, colorizator, args)
+        else:
+            colorize_pages(pages, source.read, write, colorizator, args)
+
+def colorize_worker(worker_id, image_names, target_path, colorizator, args, threads, results):
+    import torch
+
+    torch.set_num_threads(threads)
+
+    start = time.perf_counter()
+
+    try:
+        for image_name in image_names:
+            file_path = os.path.join(args.path, image_name)
+
+            print(file_path)
+
+            colorize_single_image(file_path, get_save_path(target_path, image_name, args), colorizator, args)
+    except Exception:
+        import traceback
+
+        # the parent waits for a report from every worker
+        results.put((worker_id, None, traceback.format_exc(), None))
+        return
+
+    results.put((worker_id, len(image_names), time.perf_counter() - start, get_memory_usage()))
+
+def collect_reports(workers, results):
+    '''
+    Returns the report of every worker, raises RuntimeError if a worker failed
+    or exited without a report.
+    '''
+
+    import queue
+
+    reports = {}
+
+    while len(reports) < len(workers):
+        try:
+            report = results.get(timeout = 1)
+            reports[report[0]] = report
+        except queue.Empty:
+            for worker_id, worker in enumerate(workers):
+                if worker_id not in reports and worker.exitcode not in (None, 0):
+                    raise RuntimeError("worker {} exited with code {}".format(worker_id, worker.exitcode))
+
+    for worker_id, pages, error, _ in sorted(reports.values()):
+        if pages is None:
+            raise RuntimeError("worker {} failed:\n{}".format(worker_id, error))
+
+    return sorted(reports.values())
+
+def colorize_images_sharded(target_path, colorizator, args, images = None):
+    '''
+    Splits the folder between args.workers processes. The model is loaded once
+    in this process and its parameters are shared with the workers, intra-op
+    threads are divided evenly between them.
+    '''
+
+    import torch
+    import torch.multiprocessing as mp
+
+    if colorizator.quantized is not None or colorizator.compiled:
+        raise RuntimeError("quantized and compiled models can not be shared between worker processes")
+
+    # spawn and forkserver pickle the parameters into shared memory, which would undo the mapping
+    if colorizator.mmap_weights and args.start_method != 'fork':
+        raise RuntimeError("mapped weights can only be shared with workers started with fork")
+
+    if images is None:
+        images = get_image_names(args.path)
+
+    threads = max(1, torch.get_num_threads() // args.workers)
+
+    # forked workers inherit the mapped weights as they are
+    if not colorizator.mmap_weights:
+        colorizator.share_memory()
+
+    context = mp.get_context(args.start_method)
+    results = context.Queue()
+
+    workers = [context.Process(target = colorize_worker, args = (i, images[i::args.workers], target_path, colorizator, args, threads, results))
+               for i in range(args.workers)]
+
+    for worker in workers:
+        worker.start()
+
+    try:
+        reports = collect_reports(workers, results)
+    except RuntimeError:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+
+    total_rss, total_pss = get_memory_usage()
+
+    for worker_id, pages, elapsed, (rss, pss) in reports:
+        print('worker {}: {} pages, {:.3f} pages/sec, rss {:.0f} MB'.format(worker_id, pages, pages / elapsed if elapsed > 0 else 0, rss / 2 ** 20))
+
+        total_rss += rss
+        if total_pss is not None and pss is not None:
+            total_pss += pss
+        else:
+            total_pss = None
+
+    print('{} workers x {} threads, total rss {:.0f} MB'.format(args.workers, threads, total_rss / 2 ** 20) +
+          (', total pss {:.0f} MB'.format(total_pss / 2 ** 20) if total_pss is not None else ''))
+
+def schedule_buckets(image_paths, colorizator, args):
+    '''
+    Scans page dimensions and assigns every page to one of args.buckets padded
+    shapes per orientation. Returns the bucket shape of every page and prints
+    how much of the processed area is padding.
+    '''
+
+    shapes = [colorizator.get_padded_shape(get_page_shape(image_path, colorizator, args), args.size, args.denoiser)
+              for image_path in image_paths]
+    buckets = make_buckets([padded for _, padded in shapes], args.buckets)
+
+    area = sum(resized[0] * resized[1] for resized, _ in shapes)
+    padded_area = sum(padded[0] * padded[1] for _, padded in shapes)
+    bucket_area = sum(bucket[0] * bucket[1] for bucket in buckets)
+
+    print('{} pages in {} buckets, padding waste {:.1f}% ({:.1f}% without bucketing)'.format(
+        len(image_paths), len(set(buckets)), 100 * (1 - area / bucket_area), 100 * (1 - area / padded_area)))
+
+    return buckets
+
+def colorize_images_batched(target_path, colorizator, args, images = None):
+    if images is None:
+        images = get_image_names(args.path)
+
+    image_paths = [os.path.join(args.path, image_name) for image_name in images]
+
+    buckets = schedule_buckets(image_paths, colorizator, args)
+
+    groups = {}
+    for i, bucket in enumerate(buckets):
+        groups.setdefault(bucket, []).append(i)
+
+    for bucket, indices in groups.items():
+        for start in range(0, len(indices), args.batch_size):
+            chunk = indices[start:start + args.batch_size]
+
+            for i in chunk:
+                print(image_paths[i])
+
+            pages = [read_page(image_paths[i], colorizator, args) for i in chunk]
+            colorizations = colorizator.colorize_batch(pages, batch_size = args.batch_size, size = args.size,
+                                                       apply_denoise = args.denoiser, denoise_sigma = args.denoiser_sigma,
+                                                       shapes = [bucket] * len(chunk), full_resolution = args.full_resolution,
+                                                       as_uint8 = True)
+
+            for i, colorization in zip(chunk, colorizations):
+                save_image(get_save_path(target_path, images[i], args), colorization, args)
+
+def get_weights_digest(colorizator, args):
+    '''
+    Digest of the weight files a page is colorized with, part of the cache key.
+    '''
+
+    digest = file_digest(colorizator.generator_path)
+    if args.denoiser:
+        digest += file_digest(colorizator.denoiser.weights_path)
+    if args.quantized is not None:
+        digest += file_digest(args.quantized)
+
+    return digest
+
+def get_cache_key(image_path, weights_digest, colorizator, args):
+    '''
+    Cache key of a page: digest of the encoded file, so that hits skip decoding,
+    together with the settings and weights (see get_weights_digest) it would be
+    colorized with.
+    '''
+
+    return make_key(file_digest(image_path), args.size, args.denoiser, args.denoiser_sigma, colorizator.denoiser.channels,
+                    colorizator.denoiser.tile_size, colorizator.denoiser.tile_overlap, colorizator.segment_height,
+                    colorizator.segment_overlap, args.full_resolution, args.format, args.quality, args.png_compression,
+                    args.precision, weights_digest)
+
+def check_precision(colorizator, args):
+    '''
+    Compares the reduced precision with float32 on the first pages of
+    args.precision_check, raises RuntimeError if colors differ too much.
+    '''
+
+    images = [image_name for image_name in get_image_names(args.precision_check)
+              if os.path.splitext(image_name)[1].lower() in IMAGE_EXTENSIONS]
+    pages = [read_page(os.path.join(args.precision_check, image_name), colorizator, args) for image_name in images[:args.precision_pages]]
+
+    errors = colorizator.check_precision(pages, args.precision_threshold, args.size, args.denoiser, args.denoiser_sigma)
+
+    print('{} check: delta E {} on {} pages'.format(args.precision, ', '.join('{:.2f}'.format(error) for error in errors), len(pages)))
+
+def colorize_folder(target_path, colorizator, args):
+    images = get_image_names(args.path)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResultCache(args.cache_dir, args.cache_size * 2 ** 20)
+        weights_digest = get_weights_digest(colorizator, args)
+        keys = {image_name : get_cache_key(os.path.join(args.path, image_name), weights_digest, colorizator, args) for image_name in images}
+        images = [image_name for image_name in images if not cache.get(keys[image_name], get_save_path(target_path, image_name, args))]
+
+    if images:
+        if args.workers > 1:
+            colorize_images_sharded(target_path, colorizator, args, images)
+        elif args.batch_size > 1:
+            colorize_images_batched(target_path, colorizator, args, images)
+        elif args.pipeline:
+            colorize_images_pipeline(target_path, colorizator, args, images)
+        else:
+            colorize_images(target_path, colorizator, args, images)
+
+    if cache is not None:
+        for image_name in images:
+            cache.put(keys[image_name], get_save_path(target_path, image_name, args))
+
+        cache.report()
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--path", required=True)
@@ -49,10 +458,49 @@ def parse_args():
     parser.add_argument('-g', '--gpu', dest = 'gpu', action = 'store_true')
     parser.add_argument('-nd', '--no_denoise', dest = 'denoiser', action = 'store_false')
     parser.add_argument("-ds", "--denoiser_sigma", type = int, default = 25)
+    parser.add_argument("-dc", "--denoiser_channels", type = int, choices = [1, 3], default = 1)
+    parser.add_argument("-dt", "--denoiser_tile", type = int, default = None, help = 'denoise at full resolution in tiles of this size')
+    parser.add_argument("--denoiser_tile_overlap", type = int, default = 32)
+    parser.add_argument("--denoiser_tile_workers", type = int, default = 1)
+    parser.add_argument("-sh", "--segment_height", type = int, default = None, help = 'colorize taller pages in segments of this height')
+    parser.add_argument("--segment_overlap", type = int, default = 128)
+    parser.add_argument('-fr', '--full_resolution', dest = 'full_resolution', action = 'store_true',
+                        help = 'save pages at their original resolution with upsampled colors')
     parser.add_argument("-s", "--size", type = int, default = 576)
+    parser.add_argument("-bs", "--batch_size", type = int, default = 1)
+    parser.add_argument("-b", "--buckets", type = int, default = 4)
+    parser.add_argument('-pl', '--pipeline', dest = 'pipeline', action = 'store_true')
+    parser.add_argument("--readers", type = int, default = 2)
+    parser.add_argument("--writers", type = int, default = 2)
+    parser.add_argument("--read_queue", type = int, default = 4)
+    parser.add_argument("--write_queue", type = int, default = 4)
+    parser.add_argument("-w", "--workers", type = int, default = 1)
+    parser.add_argument("--start_method", choices = ['fork', 'spawn', 'forkserver'], default = 'spawn')
+    parser.add_argument("-f", "--format", choices = ['png', 'webp', 'jpg'], default = 'png')
+    parser.add_argument("-q", "--quality", type = int, default = 95, help = 'webp and jpg quality')
+    parser.add_argument("--png_compression", type = int, default = 1, help = 'png compression level from 0 to 9')
+    parser.add_argument("-qz", "--quantized", default = None, help = 'int8 model saved by quantize.py, cpu only')
+    parser.add_argument('--fold_batchnorm', dest = 'fold_batchnorm', action = 'store_true', help = 'fold batchnorm into convolutions at load time')
+    parser.add_argument('--channels_last', dest = 'channels_last', action = 'store_true', help = 'run the models in channels-last memory format')
+    parser.add_argument('--mmap_weights', dest = 'mmap_weights', action = 'store_true', help = 'share converted .weights files between processes, cpu only')
+    parser.add_argument("--jit_cache", default = None, help = 'folder with cached TorchScript traces of the models')
+    parser.add_argument("--precision", choices = MangaColorizator.precisions, default = 'float32')
+    parser.add_argument("--precision_check", default = 'figures', help = 'pages compared with float32 before a reduced precision is used, empty to skip')
+    parser.add_argument("--precision_pages", type = int, default = 3)
+    parser.add_argument("--precision_threshold", type = float, default = 2.0, help = 'largest allowed mean delta E')
+    parser.add_argument("-c", "--cache_dir", default = None)
+    parser.add_argument("--cache_size", type = int, default = 1024, help = 'cache size limit in MB')
     parser.set_defaults(gpu = False)
+    parser.set_defaults(pipeline = False)
+    parser.set_defaults(full_resolution = False)
     parser.set_defaults(denoiser = True)
+    parser.set_defaults(fold_batchnorm = False)
+    parser.set_defaults(channels_last = False)
+    parser.set_defaults(mmap_weights = False)
     args = parser.parse_args()
+
+    if min(args.readers, args.writers, args.read_queue, args.write_queue) < 1:
+        parser.error("--readers, --writers, --read_queue and --write_queue should be at least 1")
     
     return args
 
@@ -66,23 +514,44 @@ if __name__ == "__main__":
     else:
         device = 'cpu'
         
-    colorizer = MangaColorizator(device, args.generator, args.extractor)
+    colorizer = MangaColorizator(device, args.generator, args.extractor, denoiser_channels = args.denoiser_channels,
+                                 denoiser_tile_size = args.denoiser_tile, denoiser_tile_overlap = args.denoiser_tile_overlap,
+                                 denoiser_tile_workers = args.denoiser_tile_workers, segment_height = args.segment_height,
+                                 segment_overlap = args.segment_overlap, quantized_path = args.quantized, precision = args.precision,
+                                 fold_batchnorm = args.fold_batchnorm, channels_last = args.channels_last, jit_cache_dir = args.jit_cache,
+                                 mmap_weights = args.mmap_weights)
+
+    if args.precision != 'float32' and args.precision_check:
+        check_precision(colorizer, args)
     
     if os.path.isdir(args.path):
         colorization_path = os.path.join(args.path, 'colorization')
         if not os.path.exists(colorization_path):
             os.makedirs(colorization_path)
               
-        colorize_images(colorization_path, colorizer, args)
+        colorize_folder(colorization_path, colorizer, args)
         
     elif os.path.isfile(args.path):
         
         split = os.path.splitext(args.path)
         
-        if split[1].lower() in ('.jpg', '.png', '.jpeg'):
-            new_image_path = split[0] + '_colorized' + '.png'
+        if split[1].lower() in ARCHIVE_EXTENSIONS:
+            colorize_archive(args.path, split[0] + '_colorized' + split[1], colorizer, args)
+
+        elif split[1].lower() in ('.jpg', '.png', '.jpeg'):
+            new_image_path = split[0] + '_colorized' + '.' + args.format
             
-            colorize_single_image(args.path, new_image_path, colorizer, args)
+            if args.cache_dir is not None:
+                cache = ResultCache(args.cache_dir, args.cache_size * 2 ** 20)
+                key = get_cache_key(args.path, get_weights_digest(colorizer, args), colorizer, args)
+
+                if not cache.get(key, new_image_path):
+                    colorize_single_image(args.path, new_image_path, colorizer, args)
+                    cache.put(key, new_image_path)
+
+                cache.report()
+            else:
+                colorize_single_image(args.path, new_image_path, colorizer, args)
         else:
             print('Wrong format')
     else:
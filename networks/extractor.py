@@ -86,7 +86,8 @@ class SEResNeXt_Origin(nn.Module):
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
 
         for m in self.modules():
-            if isinstance(m, nn.Conv2d):
+            # meta tensors hold no data, random init would only load the python meta kernels
+            if isinstance(m, nn.Conv2d) and not m.weight.is_meta:
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
                 m.weight.data.normal_(0, math.sqrt(2. / n))
                 if m.bias is not None:
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torchvision.models as M
 import math
 from torch import Tensor
 from torch.nn import Parameter
@@ -283,14 +282,25 @@ class Generator(nn.Module):
             nn.LeakyReLU(0.2),
         )    
         
-    def forward(self, sketch):
+    def encode(self, sketch):
+        '''
+        Encoder features of the sketch, they do not depend on the hint and can be
+        passed to forward again while only the hint changes.
+        '''
+
+        return self.encoder(sketch[:, 0:1])
+
+    def forward(self, sketch, features = None):
 
         x0 = self.to0(sketch)
         aux_out = self.to1(x0)
         aux_out = self.to2(aux_out)
         aux_out = self.to3(aux_out)
         
-        x1, x2, x3, x4 = self.encoder(sketch[:, 0:1])
+        if features is None:
+            features = self.encode(sketch)
+
+        x1, x2, x3, x4 = features
         
         out = self.tunnel4(torch.cat([x4, aux_out], 1))
         
@@ -303,17 +313,54 @@ class Generator(nn.Module):
         
         x = torch.tanh(self.exit(torch.cat([x, x0], 1)))
         
+        if self.deconv_for_decoder is None:
+            return x, None
+
         decoder_output = self.deconv_for_decoder(out)
 
         return x, decoder_output  
 
+    def remove_guide_decoder(self):
+        '''
+        Drops the guide decoder and the unused to4 block after the weights are
+        loaded, forward then returns None instead of the guide output.
+        '''
+
+        self.deconv_for_decoder = None
+        self.to4 = None
+
+        return self
+
 
 class Colorizer(nn.Module):
-    def __init__(self):
+    def __init__(self, precision = 'float32'):
         super(Colorizer, self).__init__()
         
         self.generator = Generator()
+        self.precision = precision
+        self.channels_last = False
+
+    def _autocast(self, x):
+        # weights stay in float32, convolutions run in the reduced precision and sensitive ops in float32
+        return torch.autocast(x.device.type, dtype = getattr(torch, self.precision), enabled = self.precision != 'float32')
+
+    def _to_layout(self, x):
+        return x.contiguous(memory_format = torch.channels_last) if self.channels_last else x
+
+    def encode(self, x):
+        x = self._to_layout(x)
+
+        with self._autocast(x):
+            return self.generator.encode(x)
         
-    def forward(self, x, extractor_grad = False):
-        fake, guide = self.generator(x)
+    def forward(self, x, extractor_grad = False, features = None):
+        x = self._to_layout(x)
+
+        with self._autocast(x):
+            fake, guide = self.generator(x, features)
+
+        if self.precision != 'float32':
+            fake = fake.float()
+            guide = guide.float() if guide is not None else None
+
         return fake, guide
@@ -0,0 +1,41 @@
+import os
+import argparse
+
+from colorizator import MangaColorizator
+from inference import read_page, get_image_names, IMAGE_EXTENSIONS
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Calibrates int8 generator and denoiser on a folder of pages for CPU inference')
+    parser.add_argument("-p", "--path", required = True, help = 'folder with calibration pages')
+    parser.add_argument("-o", "--output", default = 'networks/generator_int8.pth')
+    parser.add_argument("-gen", "--generator", default = 'networks/generator.zip')
+    parser.add_argument("-ext", "--extractor", default = 'networks/extractor.pth')
+    parser.add_argument('-nd', '--no_denoise', dest = 'denoiser', action = 'store_false')
+    parser.add_argument("-ds", "--denoiser_sigma", type = int, default = 25)
+    parser.add_argument("-dc", "--denoiser_channels", type = int, choices = [1, 3], default = 1)
+    parser.add_argument("-s", "--size", type = int, default = 576)
+    parser.add_argument("-n", "--num_pages", type = int, default = 32, help = 'maximum number of calibration pages')
+    parser.add_argument("--backend", choices = ['x86', 'fbgemm', 'qnnpack', 'onednn'], default = 'x86')
+    parser.set_defaults(denoiser = True)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    args.full_resolution = False
+
+    colorizer = MangaColorizator('cpu', args.generator, args.extractor, denoiser_channels = args.denoiser_channels)
+
+    images = [image_name for image_name in get_image_names(args.path) if os.path.splitext(image_name)[1].lower() in IMAGE_EXTENSIONS]
+    pages = [read_page(os.path.join(args.path, image_name), colorizer, args) for image_name in images[:args.num_pages]]
+
+    if not pages:
+        raise RuntimeError("no calibration pages found in " + args.path)
+
+    print('Calibrating on {} pages'.format(len(pages)))
+
+    colorizer.quantize(pages, args.size, args.denoiser, args.denoiser_sigma, args.backend)
+    colorizer.save_quantized(args.output)
+
+    print('Saved to ' + args.output)
@@ -0,0 +1,267 @@
+import argparse
+import base64
+import json
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import cv2
+
+from colorizator import MangaColorizator
+from inference import decode_page, encode_image
+
+CONTENT_TYPES = {'png' : 'image/png', 'webp' : 'image/webp', 'jpg' : 'image/jpeg'}
+
+class BatchingColorizer:
+    '''
+    Colorizes pages submitted from many threads with one model. A single
+    thread owns the colorizator: it waits for the first pending page, collects
+    more for up to args.max_wait milliseconds or until args.batch_size pages
+    are queued, and colorizes them with one colorize_batch call.
+    '''
+
+    def __init__(self, colorizator, args):
+        self.colorizator = colorizator
+        self.args = args
+
+        self.requests = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen = args.stats_window)
+        self.batch_sizes = Counter()
+
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def submit(self, image, hint = None):
+        '''
+        Args:
+           image: grayscale page as returned by decode_page
+           hint: None or (hint, mask) pair shaped like the padded page (see update_hint)
+        Returns:
+           concurrent.futures.Future with the uint8 RGB colorization
+        '''
+
+        future = Future()
+        self.requests.put((image, hint, future))
+
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.args.max_wait / 1000
+
+        while len(batch) < self.args.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self.requests.get(timeout = timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _colorize(self, images, hints):
+        padded = [self.colorizator.get_padded_shape(image.shape, self.args.size, self.args.denoiser)[1] for image in images]
+
+        # pages of one orientation are padded to a common shape so that they share a forward pass
+        common = {}
+        for shape in padded:
+            portrait = shape[0] >= shape[1]
+            current = common.get(portrait, shape)
+            common[portrait] = (max(current[0], shape[0]), max(current[1], shape[1]))
+
+        shapes = [common[shape[0] >= shape[1]] for shape in padded]
+
+        return self.colorizator.colorize_batch(images, hints, self.args.batch_size, self.args.size, self.args.denoiser,
+                                               self.args.denoiser_sigma, shapes = shapes,
+                                               full_resolution = self.args.full_resolution, as_uint8 = True)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            images, hints, futures = map(list, zip(*batch))
+
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+
+            try:
+                colorizations = self._colorize(images, hints)
+            except Exception:
+                # a bad page should not fail the requests it was batched with
+                colorizations = []
+                for image, hint, future in batch:
+                    try:
+                        colorizations.append(self._colorize([image], [hint])[0])
+                    except Exception as e:
+                        colorizations.append(e)
+
+            for future, colorization in zip(futures, colorizations):
+                if isinstance(colorization, Exception):
+                    future.set_exception(colorization)
+                else:
+                    future.set_result(colorization)
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+
+        stats = {'requests' : len(latencies), 'batch_sizes' : batch_sizes}
+
+        if len(latencies):
+            stats['latency_ms'] = {'p{}'.format(p) : float(np.percentile(latencies, p)) for p in (50, 90, 99)}
+            stats['latency_ms']['mean'] = float(latencies.mean())
+
+        return stats
+
+def decode_hint(hint, mask):
+    hint = base64.b64decode(hint)
+    mask = base64.b64decode(mask)
+
+    if not hint or not mask:
+        raise RuntimeError("hint and mask should not be empty")
+
+    hint = cv2.imdecode(np.frombuffer(hint, np.uint8), cv2.IMREAD_COLOR)
+    mask = cv2.imdecode(np.frombuffer(mask, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    if hint is None or mask is None:
+        raise RuntimeError("hint can not be decoded")
+
+    if hint.shape[:2] != mask.shape:
+        raise RuntimeError("hint and mask shapes do not match")
+
+    return cv2.cvtColor(hint, cv2.COLOR_BGR2RGB), mask.astype(np.float32) / 255
+
+class ColorizationHandler(BaseHTTPRequestHandler):
+    '''
+    POST /colorize with an encoded page as the body, or a JSON object with
+    base64 encoded "image" and optional "hint" (color) and "mask" (grayscale)
+    images shaped like the padded page, returns the encoded colorization.
+    GET /stats returns latency percentiles and the batch size histogram.
+    '''
+
+    def _send(self, code, content_type, data):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _parse(self, body):
+        colorizator, args = self.server.batcher.colorizator, self.server.batcher.args
+        hint = None
+
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            request = json.loads(body)
+            image = decode_page(base64.b64decode(request['image']), colorizator, args)
+
+            if request.get('hint') is not None:
+                hint = decode_hint(request['hint'], request['mask'])
+                shape = colorizator.get_padded_shape(image.shape, args.size, args.denoiser)[1]
+
+                if hint[0].shape[:2] != shape:
+                    raise RuntimeError("hint should be shaped like the padded page {}".format(shape))
+        else:
+            image = decode_page(body, colorizator, args)
+
+        return image, hint
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+
+        self._send(200, 'application/json', json.dumps(self.server.batcher.stats()).encode())
+
+    def do_POST(self):
+        if self.path != '/colorize':
+            self.send_error(404)
+            return
+
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        try:
+            image, hint = self._parse(body)
+        except (ValueError, KeyError, RuntimeError) as e:
+            self.send_error(400, str(e))
+            return
+
+        try:
+            colorization = self.server.batcher.submit(image, hint).result()
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        args = self.server.batcher.args
+        self._send(200, CONTENT_TYPES[args.format], encode_image(colorization, args))
+
+        self.server.batcher.record_latency(time.perf_counter() - start)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def make_server(colorizator, args):
+    server = ThreadingHTTPServer((args.host, args.port), ColorizationHandler)
+    server.daemon_threads = True
+    server.batcher = BatchingColorizer(colorizator, args)
+    server.verbose = args.verbose
+
+    return server
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default = '127.0.0.1')
+    parser.add_argument("--port", type = int, default = 8000)
+    parser.add_argument("-gen", "--generator", default = 'networks/generator.zip')
+    parser.add_argument("-ext", "--extractor", default = 'networks/extractor.pth')
+    parser.add_argument('-g', '--gpu', dest = 'gpu', action = 'store_true')
+    parser.add_argument('-nd', '--no_denoise', dest = 'denoiser', action = 'store_false')
+    parser.add_argument("-ds", "--denoiser_sigma", type = int, default = 25)
+    parser.add_argument("-dc", "--denoiser_channels", type = int, choices = [1, 3], default = 1)
+    parser.add_argument("-s", "--size", type = int, default = 576)
+    parser.add_argument('-fr', '--full_resolution', dest = 'full_resolution', action = 'store_true')
+    parser.add_argument("-bs", "--batch_size", type = int, default = 4)
+    parser.add_argument("-mw", "--max_wait", type = float, default = 20, help = 'milliseconds to wait for a batch to fill')
+    parser.add_argument("-f", "--format", choices = ['png', 'webp', 'jpg'], default = 'png')
+    parser.add_argument("-q", "--quality", type = int, default = 95, help = 'webp and jpg quality')
+    parser.add_argument("--png_compression", type = int, default = 1, help = 'png compression level from 0 to 9')
+    parser.add_argument("--stats_window", type = int, default = 1000, help = 'number of latest requests in latency statistics')
+    parser.add_argument('--mmap_weights', dest = 'mmap_weights', action = 'store_true', help = 'share converted .weights files between processes, cpu only')
+    parser.add_argument('-v', '--verbose', dest = 'verbose', action = 'store_true')
+    parser.set_defaults(gpu = False)
+    parser.set_defaults(full_resolution = False)
+    parser.set_defaults(denoiser = True)
+    parser.set_defaults(verbose = False)
+    parser.set_defaults(mmap_weights = False)
+
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    device = 'cuda' if args.gpu else 'cpu'
+
+    colorizer = MangaColorizator(device, args.generator, args.extractor, denoiser_channels = args.denoiser_channels,
+                                 mmap_weights = args.mmap_weights)
+
+    server = make_server(colorizer, args)
+    print('Serving on http://{}:{}'.format(args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,115 @@
+import os
+import shutil
+import hashlib
+
+import numpy as np
+
+def file_digest(path, chunk_size = 2 ** 20):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def make_key(*parts):
+    '''
+    Digest of the given parts, numpy arrays are hashed by dtype, shape and
+    contents, everything else by its repr.
+    '''
+
+    digest = hashlib.sha256()
+
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(repr((part.dtype.str, part.shape)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+class ResultCache:
+    '''
+    On-disk cache of colorized pages addressed by a key built with make_key.
+    Entries are stored as the encoded output files, the least recently used
+    ones are removed once the cache grows over max_size bytes.
+    '''
+
+    def __init__(self, cache_dir, max_size = 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok = True)
+
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return entries
+
+    def get(self, key, save_path):
+        '''
+        Copies the cached result for key to save_path, returns False on a miss.
+        '''
+
+        entry_path = self._entry_path(key)
+
+        try:
+            shutil.copyfile(entry_path, save_path)
+            os.utime(entry_path)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        return True
+
+    def put(self, key, save_path):
+        entry_path = self._entry_path(key)
+        tmp_path = entry_path + '.tmp'
+
+        if os.path.exists(entry_path):
+            self.size -= os.path.getsize(entry_path)
+
+        shutil.copyfile(save_path, tmp_path)
+        os.replace(tmp_path, entry_path)
+
+        self.size += os.path.getsize(entry_path)
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes least recently used entries until the cache fits into max_size.
+        '''
+
+        entries = self._entries()
+        self.size = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if self.size <= self.max_size:
+                break
+
+            os.remove(path)
+            self.size -= size
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0
+
+        print('cache: {} hits, {} misses, hit rate {:.1f}%'.format(self.hits, self.misses, hit_rate))
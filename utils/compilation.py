@@ -0,0 +1,65 @@
+import os
+import shutil
+import warnings
+
+import torch
+
+def trace_modules(modules, example_inputs):
+    '''
+    Traces every module of the dict name -> module with its example inputs
+    and freezes the result, so weights become constants of the graph.
+    '''
+
+    traced = {}
+
+    with torch.no_grad(), warnings.catch_warnings():
+        # torch.jit warns that it is deprecated on every call
+        warnings.simplefilter('ignore', FutureWarning)
+
+        for name, module in modules.items():
+            traced[name] = torch.jit.freeze(torch.jit.trace(module.eval(), example_inputs[name]))
+
+    return traced
+
+class TracedModelCache:
+    '''
+    On-disk cache of traced modules: a folder per key with a TorchScript
+    archive per module name.
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _path(self, key, name = None):
+        path = os.path.join(self.cache_dir, key)
+        return path if name is None else os.path.join(path, name + '.pt')
+
+    def load(self, key, names, device):
+        '''
+        Returns a dict name -> module, or None if any module is missing.
+        '''
+
+        if not all(os.path.exists(self._path(key, name)) for name in names):
+            return None
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+
+            return {name : torch.jit.load(self._path(key, name), map_location = device) for name in names}
+
+    def save(self, key, traced):
+        tmp_path = self._path(key) + '.tmp'
+
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        os.makedirs(tmp_path)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+
+            for name, module in traced.items():
+                torch.jit.save(module, os.path.join(tmp_path, name + '.pt'))
+
+        shutil.rmtree(self._path(key), ignore_errors = True)
+        os.replace(tmp_path, self._path(key))
@@ -0,0 +1,35 @@
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+def _foldable(conv, bn):
+    return isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and conv.out_channels == bn.num_features
+
+def fold_batchnorm(model):
+    '''
+    Folds every BatchNorm2d that directly follows a Conv2d into the conv
+    weights and replaces it with nn.Identity, for models in eval mode. Pairs
+    are taken from consecutive layers of nn.Sequential and from convN/bnN
+    attributes, as in the SEResNeXt extractor. Returns the number of folded layers.
+    '''
+
+    if model.training:
+        raise RuntimeError("batchnorm can only be folded in eval mode")
+
+    folded = 0
+
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            pairs = [(str(i), str(i + 1)) for i in range(len(module) - 1)]
+        else:
+            pairs = [('conv' + name[2:], name) for name, _ in module.named_children() if name.startswith('bn')]
+
+        for conv_name, bn_name in pairs:
+            conv = getattr(module, conv_name, None)
+            bn = getattr(module, bn_name)
+
+            if _foldable(conv, bn):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+                folded += 1
+
+    return folded
@@ -0,0 +1,63 @@
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from utils.utils import set_submodule
+
+def capture_inputs(modules, run):
+    '''
+    Calls run() and returns the positional inputs every module in the dict
+    name -> module received on its first call.
+    '''
+
+    inputs = {}
+
+    def hook(name):
+        return lambda module, args: inputs.setdefault(name, tuple(arg.detach() for arg in args))
+
+    handles = [module.register_forward_pre_hook(hook(name)) for name, module in modules.items()]
+
+    try:
+        with torch.no_grad():
+            run()
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return inputs
+
+def prepare_submodules(model, names, example_inputs, backend = 'x86'):
+    '''
+    Replaces the submodules of model with the given names by FX graph modules
+    with observers for static int8 quantization. Run calibration data through
+    model afterwards and call convert_submodules. Every submodule keeps float
+    inputs and outputs, so code around them does not change.
+    '''
+
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+
+    for name in names:
+        set_submodule(model, name, prepare_fx(model.get_submodule(name).eval(), qconfig_mapping, example_inputs[name]))
+
+    return model
+
+def _disable_inplace(module):
+    # quantized activations ignore inplace and warn about it on every call
+    for node in module.graph.nodes:
+        if node.kwargs.get('inplace', False):
+            node.kwargs = dict(node.kwargs, inplace = False)
+
+    for submodule in module.modules():
+        if getattr(submodule, 'inplace', False):
+            submodule.inplace = False
+
+    module.recompile()
+
+    return module
+
+def convert_submodules(model, names):
+    for name in names:
+        set_submodule(model, name, _disable_inplace(convert_fx(model.get_submodule(name))))
+
+    return model
@@ -2,15 +2,10 @@ import numpy as np
 import cv2
 
 def resize_pad(img, size = 256):
-            
-    if len(img.shape) == 2:
-        img = np.expand_dims(img, 2)
-        
-    if img.shape[2] == 1:
-        img = np.repeat(img, 3, 2)
-        
-    if img.shape[2] == 4:
-        img = img[:, :, :3]
+
+    # only the first channel is used by the colorizer
+    if len(img.shape) == 3:
+        img = img[:, :, 0]
 
     pad = None        
             
@@ -25,7 +20,7 @@ def resize_pad(img, size = 256):
             
         pad = (0, new_width - width)
         
-        img = np.pad(img, ((0, 0), (0, pad[1]), (0, 0)), 'maximum')
+        img = np.pad(img, ((0, 0), (0, pad[1])), 'maximum')
     else:
         width = img.shape[1]
         ratio = width / size
@@ -36,9 +31,265 @@ def resize_pad(img, size = 256):
             
         pad = (new_height - height, 0)
         
-        img = np.pad(img, ((0, pad[0]), (0, 0), (0, 0)), 'maximum')
+        img = np.pad(img, ((0, pad[0]), (0, 0)), 'maximum')
         
     if (img.dtype == 'float32'):
         np.clip(img, 0, 1, out = img)
 
-    return img[:, :, :1], pad
+    return img[:, :, np.newaxis], pad
+
+def get_padded_shape(shape, size = 256):
+    '''
+    Returns (resized_shape, padded_shape) that resize_pad produces for an
+    image with shape (height, width) without touching any pixels.
+    '''
+
+    if (shape[0] < shape[1]):
+        height = int(size * 1.5)
+        width = int(np.ceil(shape[1] / (shape[0] / height)))
+
+        return (height, width), (height, width + (32 - width % 32))
+    else:
+        width = size
+        height = int(np.ceil(shape[0] / (shape[1] / width)))
+
+        return (height, width), (height + (32 - height % 32), width)
+
+def pad_to_shape(img, pad, shape):
+    '''
+    Pads an output of resize_pad further up to shape (height, width) the same
+    way resize_pad does and returns the image together with the updated pad.
+    Dimensions that already exceed shape are left as they are.
+    '''
+
+    extra = (max(shape[0] - img.shape[0], 0), max(shape[1] - img.shape[1], 0))
+
+    if extra != (0, 0):
+        img = np.pad(img, ((0, extra[0]), (0, extra[1]), (0, 0)), 'maximum')
+
+    return img, (pad[0] + extra[0], pad[1] + extra[1])
+
+def _split_lengths(lengths, num_buckets):
+    values = sorted(set(lengths))
+    counts = [lengths.count(value) for value in values]
+    num_buckets = min(num_buckets, len(values))
+
+    count_sums = np.cumsum([0] + counts)
+    length_sums = np.cumsum([0] + [value * count for value, count in zip(values, counts)])
+
+    # padding added to values i..j when they share a bucket of length values[j]
+    def cost(i, j):
+        return values[j] * (count_sums[j + 1] - count_sums[i]) - (length_sums[j + 1] - length_sums[i])
+
+    best = [[float('inf')] * len(values) for _ in range(num_buckets)]
+    split = [[0] * len(values) for _ in range(num_buckets)]
+
+    for j in range(len(values)):
+        best[0][j] = cost(0, j)
+
+    for b in range(1, num_buckets):
+        for j in range(b, len(values)):
+            for i in range(b, j + 1):
+                candidate = best[b - 1][i - 1] + cost(i, j)
+                if candidate < best[b][j]:
+                    best[b][j] = candidate
+                    split[b][j] = i
+
+    edges = []
+    j = len(values) - 1
+    for b in range(num_buckets - 1, -1, -1):
+        edges.append(values[j])
+        j = split[b][j] - 1
+
+    return sorted(edges)
+
+def make_buckets(shapes, num_buckets = 4):
+    '''
+    Assigns padded shapes produced by get_padded_shape to at most num_buckets
+    bucket shapes per orientation so that the total padded area is minimal.
+
+    Args:
+        shapes: list of padded shapes (height, width)
+        num_buckets: number of buckets per orientation
+    Returns:
+        list with the bucket shape of every input shape
+    '''
+
+    portrait = [shape[0] for shape in shapes if shape[0] >= shape[1]]
+    landscape = [shape[1] for shape in shapes if shape[0] < shape[1]]
+
+    portrait_edges = _split_lengths(portrait, num_buckets) if portrait else []
+    landscape_edges = _split_lengths(landscape, num_buckets) if landscape else []
+
+    buckets = []
+    for shape in shapes:
+        if shape[0] >= shape[1]:
+            height = next(edge for edge in portrait_edges if edge >= shape[0])
+            buckets.append((height, shape[1]))
+        else:
+            width = next(edge for edge in landscape_edges if edge >= shape[1])
+            buckets.append((shape[0], width))
+
+    return buckets
+
+def set_submodule(model, name, module):
+    '''
+    Replaces the submodule of model with the dotted name, e.g. generator.tunnel4.
+    '''
+
+    parent, _, child = name.rpartition('.')
+    setattr(model.get_submodule(parent) if parent else model, child, module)
+
+def get_memory_usage(pid = 'self'):
+    '''
+    Returns (rss, pss) of a process in bytes. pss counts shared pages
+    proportionally to the number of processes mapping them and is None
+    where /proc/<pid>/smaps_rollup is not available.
+    '''
+
+    rss = None
+    pss = None
+
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('Pss:'):
+                    pss = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if rss is None:
+        import resource
+        import sys
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss *= 1 if sys.platform == 'darwin' else 1024
+
+    return rss, pss
+
+def color_difference(a, b):
+    '''
+    Per-pixel CIE76 color difference (delta E in Lab) of two float RGB images in [0, 1].
+    '''
+
+    lab_a = cv2.cvtColor(np.ascontiguousarray(a, dtype = np.float32), cv2.COLOR_RGB2Lab)
+    lab_b = cv2.cvtColor(np.ascontiguousarray(b, dtype = np.float32), cv2.COLOR_RGB2Lab)
+
+    return np.linalg.norm(lab_a - lab_b, axis = 2)
+
+def restore_luminance(colorization, image):
+    '''
+    Brings a colorization computed at network resolution to the resolution of
+    the original page: only the chroma is upsampled, the luminance is taken
+    from the full resolution grayscale page.
+
+    Args:
+        colorization: float RGB image in [0, 1]
+        image: the original page, its first channel is used as luminance
+    Returns:
+        float32 RGB image in [0, 1] with the height and width of image
+    '''
+
+    if len(image.shape) == 3:
+        image = image[:, :, 0]
+
+    if issubclass(image.dtype.type, np.integer):
+        luminance = image.astype(np.float32) / np.iinfo(image.dtype).max
+    else:
+        luminance = image.astype(np.float32)
+
+    height, width = luminance.shape
+
+    # YCrCb is linear in RGB, so converting before upsampling only resizes the two chroma channels
+    chroma = cv2.cvtColor(np.ascontiguousarray(colorization, dtype = np.float32), cv2.COLOR_RGB2YCrCb)[:, :, 1:]
+    chroma = cv2.resize(chroma, (width, height), interpolation = cv2.INTER_LINEAR)
+
+    result = cv2.cvtColor(np.dstack([luminance, chroma]), cv2.COLOR_YCrCb2RGB)
+    np.clip(result, 0, 1, out = result)
+
+    return result
+
+_reduced_decode_flags = {8 : cv2.IMREAD_REDUCED_GRAYSCALE_8, 4 : cv2.IMREAD_REDUCED_GRAYSCALE_4, 2 : cv2.IMREAD_REDUCED_GRAYSCALE_2}
+
+def get_decode_scale(shape, size, min_side = None):
+    '''
+    Returns the factor (1, 2, 4 or 8) by which decode_image downscales a JPEG
+    image with shape (height, width).
+    '''
+
+    height, width = shape[:2]
+    longest = 0 if min_side is None else min(min_side, max(height, width))
+
+    for scale in sorted(_reduced_decode_flags, reverse = True):
+        reduced_height, reduced_width = -(-height // scale), -(-width // scale)
+
+        if height >= width:
+            fits = reduced_width >= size
+        else:
+            fits = reduced_height >= size * 1.5
+
+        if fits and max(reduced_height, reduced_width) >= longest:
+            return scale
+
+    return 1
+
+def get_decoded_shape(shape, size, min_side = None):
+    '''
+    Returns the (height, width) decode_image produces for a JPEG image with
+    shape (height, width) without decoding it.
+    '''
+
+    scale = get_decode_scale(shape, size, min_side)
+
+    return -(-shape[0] // scale), -(-shape[1] // scale)
+
+def decode_image(data, size = None, min_side = None):
+    '''
+    Decodes an encoded image straight to a single channel uint8 array. With
+    size given JPEG images are downscaled by the decoder by 2, 4 or 8 as long
+    as the result stays large enough for resize_pad with this size and keeps
+    its longest side at least min_side (or the original one if smaller).
+
+    Args:
+        data: bytes of the encoded image
+    '''
+
+    if len(data) == 0:
+        raise RuntimeError("image is empty")
+
+    data = np.frombuffer(data, dtype = np.uint8)
+    flags = cv2.IMREAD_GRAYSCALE
+
+    if size is not None and data[:3].tobytes() == b'\xff\xd8\xff':
+        import io
+        from PIL import Image
+
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                width, height = image.size
+        except OSError:
+            # broken headers are left to imdecode
+            height = width = None
+
+        if height is not None:
+            scale = get_decode_scale((height, width), size, min_side)
+
+            if scale != 1:
+                flags = _reduced_decode_flags[scale]
+
+    image = cv2.imdecode(data, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+
+    if image is None:
+        raise RuntimeError("image can not be decoded")
+
+    return image
+
+def load_image(image_path, size = None, min_side = None):
+    '''
+    Reads and decodes an image file with decode_image.
+    '''
+
+    with open(image_path, 'rb') as f:
+        return decode_image(f.read(), size, min_side)
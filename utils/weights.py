@@ -0,0 +1,82 @@
+import json
+import struct
+
+import numpy as np
+
+# file layout: magic, little-endian uint64 header size, JSON header, tensor data aligned to ALIGNMENT bytes
+MAGIC = b'MCWEIGHT'
+ALIGNMENT = 64
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def save_weights(state_dict, path):
+    '''
+    Writes a state dict of CPU tensors without pickle: a JSON header with the
+    dtype, shape and offset of every tensor followed by their raw data, so that
+    load_weights can map the file instead of reading it.
+    '''
+
+    arrays = {name : tensor.detach().cpu().contiguous().numpy() for name, tensor in state_dict.items()}
+
+    tensors = {}
+    offset = 0
+    for name, array in arrays.items():
+        tensors[name] = {'dtype' : array.dtype.str, 'shape' : list(array.shape), 'offset' : offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps(tensors).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+
+        for name, array in arrays.items():
+            f.seek(data_start + tensors[name]['offset'])
+            f.write(array.tobytes())
+
+        f.truncate(data_start + offset)
+
+def load_weights(path):
+    '''
+    Maps a file written by save_weights and returns a state dict of CPU
+    tensors backed by the mapping. Pages are only read when a tensor is used
+    and stay shared with the page cache until a tensor is written to.
+    '''
+
+    import torch
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError(path + " is not a weights file")
+
+        header_size, = struct.unpack('<Q', f.read(8))
+        tensors = json.loads(f.read(header_size))
+
+    data_start = _align(len(MAGIC) + 8 + header_size)
+
+    # copy-on-write mapping: tensors are writable without touching the file
+    data = np.memmap(path, dtype = np.uint8, mode = 'c', offset = data_start) if tensors else None
+
+    state_dict = {}
+    for name, info in tensors.items():
+        dtype = np.dtype(info['dtype'])
+        size = int(np.prod(info['shape'])) * dtype.itemsize
+
+        array = data[info['offset']:info['offset'] + size].view(dtype).reshape(info['shape'])
+        state_dict[name] = torch.from_numpy(array)
+
+    return state_dict
+
+def read_state_dict(path, map_location = 'cpu'):
+    '''
+    Loads a state dict from a .weights file written by save_weights, or from
+    any other file with torch.load.
+    '''
+
+    if path.endswith('.weights'):
+        return load_weights(path)
+
+    import torch
+
+    return torch.load(path, map_location = map_location)